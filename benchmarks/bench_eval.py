@@ -0,0 +1,228 @@
+'''Stage benchmark of the valuation pipeline on synthetic datasets, run from the repository root:
+
+    python -m benchmarks.bench_eval [--tickers 800] [--years 10] [--save-baseline]
+
+Generates biznesradar and Google Finance format datasets in a temporary directory (see
+benchmarks.synthetic, about edge_rate of the companies have negative equity, no dividends, losses
+or a short history) and times each stage for both - reading the JSON files, refining them into
+Financials, filtering, valuation and writing the CSV, plus prep_companies + eval_stocks end to end,
+the batch Screener and the report page parsers. Every stage is run "repeat" times and the best time
+is kept, a separate pass under tracemalloc gives the peak memory of each stage.
+
+Results are compared with the baseline file if there is one made with the same dataset parameters,
+stages slower than the baseline by more than the tolerance are reported as regressions and the
+exit code is 1. Nothing is fetched from the network'''
+from benchmarks.synthetic import br_dataset, gf_dataset
+from benchmarks.bench_parsers import bench as bench_parsers, load_pages
+import biznesradar_scraper as br
+import bizsval as bv
+from bizsval import BrHandler, GfHandler, Company, Financials, passes_filters, value_company, save_results
+from screener import Screener
+from instrument import log
+from contextlib import redirect_stdout
+import tracemalloc
+import logging
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+BASELINE = "benchmarks/baseline.json"
+TOLERANCE = 0.25
+FILTERS = (0.05, 0.08, 0.5, 5) # margin, ROE, ROE deviation and years back of eval_br
+
+class OfflineBrHandler(BrHandler):
+    '''BrHandler with market caps of the synthetic dataset instead of scraped ones'''
+    def __init__(self, dir_, caps):
+        super().__init__(dir_)
+        self.caps = caps
+
+    def get_market_cap(self, name, from_file):
+        return self.caps[name]
+
+def read_br(handler, name):
+    '''Raw statements of a ticker as read by BrHandler.get_financials'''
+    raw = {}
+    for statement in (br.INCOME, br.BALANCE, br.CASH):
+        with open(f"{handler.dir}/{name}-{statement}.json") as file:
+            raw.update(json.load(file))
+    return raw
+
+def read_gf(handler, name):
+    with open(f"{handler.dir_}/{name}.json") as file:
+        return json.load(file)
+
+def refine_gf(handler, name, raw):
+    '''GfHandler.get_financials after reading the file - market cap adjustment and conversion
+    to Financials done by Company'''
+    if not raw['pe'] == "NaN":
+        handler.market_caps[name] = handler.adjust_market_cap(raw['pe'], raw['market_cap'], raw["net_income"])
+    return Financials(raw)
+
+def run_stages(source, handler, tickers, out_dir):
+    '''One run of all stages for a dataset, returns a dict of stage: (seconds, items processed, peak
+    memory allocated by the stage), peaks are 0 unless tracemalloc is tracing'''
+    read, refine = (read_br, lambda h, n, raw: h.refine_financials(raw)) if source == "br" else (read_gf, refine_gf)
+    margin_filter, roe_filter, deviation_filter, backyears = FILTERS
+    stages = {}
+    def stage(name, func, items):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        stages[name] = (seconds, items, tracemalloc.get_traced_memory()[1] - base if tracing else 0)
+        return result
+
+    raws = stage("load", lambda: {t: read(handler, t) for t in tickers}, len(tickers))
+
+    def refine_all():
+        companies = []
+        for t in tickers:
+            try:
+                c = Company(t, handler)
+                c.financials = refine(handler, t, raws[t])
+                companies.append(c)
+            except Exception:
+                pass
+        return companies
+    companies = stage("refine", refine_all, len(tickers))
+
+    def filter_all():
+        passed = []
+        for c in companies:
+            try:
+                if passes_filters(c, margin_filter, roe_filter, deviation_filter, backyears):
+                    passed.append(c)
+            except Exception:
+                pass
+        return passed
+    passed = stage("filter", filter_all, len(companies))
+
+    def value_all():
+        results = []
+        for c in passed:
+            try:
+                c.set_market_cap()
+                results.append(value_company(c, margin_years=backyears))
+            except Exception:
+                pass
+        return results
+    results = stage("valuation", value_all, len(passed))
+    stage("csv", lambda: save_results(results, out_dir, source), len(results))
+
+    def end_to_end():
+        companies = bv.prep_companies(handler, tickers, None, use_black_list=False)
+        bv.eval_stocks(companies, out_dir, source, *FILTERS, False, None, workers=1, market_cap_cache=None)
+    stage("prep + eval_stocks", end_to_end, len(tickers))
+
+    def batch():
+        screener = Screener(companies)
+        passed = screener.screen(*FILTERS)
+        screener.set_market_caps({c.name: c.market_cap for c in companies if c.market_cap})
+        return screener.results(passed, margin_filter, backyears)
+    stage("screener", batch, len(companies))
+    return stages
+
+def run(source, tickers, years, seed, edge_rate, repeat):
+    '''Benchmarks a synthetic dataset of one source, returns a dict of stage: seconds, items per
+    second and peak traced memory in bytes'''
+    tmp = tempfile.mkdtemp()
+    try:
+        if source == "br":
+            caps = br_dataset(f"{tmp}/gpw", tickers, years, seed, edge_rate)
+            make_handler = lambda: OfflineBrHandler(f"{tmp}/gpw", caps)
+        else:
+            gf_dataset(f"{tmp}/gf", tickers, years, seed, edge_rate)
+            make_handler = lambda: GfHandler(f"{tmp}/gf")
+        names = sorted(caps) if source == "br" else sorted(n[:-5] for n in os.listdir(f"{tmp}/gf"))
+        best = {}
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for r in range(repeat):
+                for name, (seconds, items, _) in run_stages(source, make_handler(), names, tmp).items():
+                    if name not in best or seconds < best[name][0]:
+                        best[name] = (seconds, items)
+            tracemalloc.start()
+            try:
+                peaks = {name: peak for name, (_, _, peak) in run_stages(source, make_handler(), names, tmp).items()}
+            finally:
+                tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmp)
+    return {name: {"seconds": seconds, "per second": items / seconds if seconds else 0.0, "peak": peaks[name]}
+            for name, (seconds, items) in best.items()}
+
+def parser_stages(pages, repeat):
+    '''Seconds per report page of each parser backend, see bench_parsers, memory is not traced'''
+    return {f"parse {backend}": {"seconds": t, "per second": 1 / t, "peak": None}
+            for backend, t in bench_parsers(pages, repeat).items()}
+
+def load_baseline(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    '''Prints timings next to the baseline, returns a list of stages slower than the baseline
+    by more than tolerance (a fraction)'''
+    regressions = []
+    for source, stages in report["results"].items():
+        print(f"\n{source}")
+        print(f"{'stage':20} {'seconds':>10} {'items/s':>12} {'peak MB':>9} {'baseline':>10}")
+        for name, r in stages.items():
+            peak = f"{r['peak'] / 2**20:9.2f}" if r["peak"] is not None else f"{'':9}"
+            line = f"{name:20} {r['seconds']:10.4f} {r['per second']:12.0f} {peak}"
+            base = baseline and baseline["results"].get(source, {}).get(name)
+            if base:
+                ratio = r["seconds"] / base["seconds"] if base["seconds"] else 1
+                line += f" {ratio:9.2f}x"
+                if ratio > 1 + tolerance:
+                    regressions.append(f"{source} {name}")
+                    line += "  REGRESSION"
+            print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the valuation pipeline")
+    parser.add_argument("--tickers", type=int, default=800, help="companies per dataset")
+    parser.add_argument("--years", type=int, default=10, help="years of biznesradar data, Google Finance has 5")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--edge-rate", type=float, default=0.1, help="fraction of edge case companies")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=20, help="synthetic report pages for the parser stages")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+    log.setLevel(logging.CRITICAL) # edge cases would log errors for every company
+
+    config = {"tickers": args.tickers, "years": args.years, "seed": args.seed,
+              "edge rate": args.edge_rate, "pages": args.pages}
+    report = {"config": config, "results": {
+        "br": run("br", args.tickers, args.years, args.seed, args.edge_rate, args.repeat),
+        "gf": run("gf", args.tickers, 5, args.seed, args.edge_rate, args.repeat),
+        "parsers": parser_stages(load_pages([])[:args.pages], args.repeat)
+    }}
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline["config"] != config:
+        print(f"baseline {args.baseline} was made with {baseline['config']}, not compared")
+        baseline = None
+    regressions = compare(report, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=1)
+        print(f"\nbaseline saved to {args.baseline}")
+    if regressions:
+        print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
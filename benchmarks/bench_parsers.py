@@ -0,0 +1,49 @@
+'''Microbenchmark of biznesradar_scraper parser backends, run from the repository root:
+
+    python -m benchmarks.bench_parsers [saved report pages...]
+
+Pages can be plain or gzipped (e.g. from the data/html response cache), without arguments 
+synthetic pages are used. Each backend has to produce the same statement 
+and info dicts as the original pure python html.parser'''
+import biznesradar_scraper as br
+from benchmarks.synthetic import report_page
+import gzip
+import sys
+import time
+
+BACKENDS = ["html.parser", "lxml", "targeted"]
+
+def load_pages(paths):
+    if paths:
+        pages = []
+        for path in paths:
+            with (gzip.open if path.endswith(".gz") else open)(path, 'rb') as f:
+                pages.append(f.read())
+        return pages
+    return [report_page(f"T{i}", seed=i) for i in range(20)]
+
+def parse(page, backend):
+    return br.parse_report(page, with_info=1, parser=backend)
+
+def bench(pages, repeat=3):
+    expected = [parse(page, "html.parser") for page in pages]
+    timings = {}
+    for backend in BACKENDS:
+        best = None
+        for r in range(repeat):
+            start = time.perf_counter()
+            results = [parse(page, backend) for page in pages]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if results != expected:
+            raise AssertionError(f"{backend} output differs from html.parser")
+        timings[backend] = best / len(pages)
+    return timings
+
+if __name__ == "__main__":
+    pages = load_pages(sys.argv[1:])
+    timings = bench(pages)
+    base = timings["html.parser"]
+    print(f"{len(pages)} pages, output identical for all backends")
+    for backend, t in timings.items():
+        print(f"{backend:12} {t * 1000:8.2f} ms/page  {base / t:5.1f}x")
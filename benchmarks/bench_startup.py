@@ -0,0 +1,69 @@
+'''Cold start benchmark of the bizsval command line, run from the repository root:
+
+    python -m benchmarks.bench_startup [--tickers 200] [--repeat 5]
+
+Every measurement is a fresh interpreter, bytecode is compiled into a temporary cache by a warm-up
+run first so only imports and work are timed. Compares "import bizsval" with importing everything
+bizsval used to load eagerly (the scraper backends requests, bs4, lxml and Selenium, NumPy and
+pyarrow), lists heavy modules an import of bizsval still pulls in and times an offline
+"bizsval screen" of a synthetic biznesradar dataset end to end'''
+from benchmarks.synthetic import br_dataset
+from importlib.util import find_spec
+import subprocess
+import argparse
+import tempfile
+import shutil
+import time
+import json
+import sys
+import os
+
+HEAVY = ["requests", "bs4", "lxml.html", "selenium.webdriver", "numpy", "pyarrow", "aiohttp"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(args, env, repeat):
+    '''Best wall time of a python command in fresh interpreters, returns seconds and the last output'''
+    best = None
+    for r in range(repeat + 1): # the first run fills the bytecode cache
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable] + args, env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        if r:
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the bizsval command line")
+    parser.add_argument("--tickers", type=int, default=200, help="companies of the screened dataset")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=f"{tmp}/pycache")
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    try:
+        eager = ["bizsval"] + [m for m in HEAVY if m != "aiohttp" and find_spec(m.split(".")[0])]
+        timings = {
+            "interpreter": run(["-c", "pass"], env, args.repeat)[0],
+            "import bizsval": run(["-c", "import bizsval"], env, args.repeat)[0],
+            "eager imports": run(["-c", f"import {', '.join(eager)}"], env, args.repeat)[0]
+        }
+        loaded = json.loads(run(["-c", f"import bizsval, sys, json; print(json.dumps([m for m in {HEAVY} if m in sys.modules]))"],
+                                env, 0)[1])
+        tickers = sorted(br_dataset(f"{tmp}/gpw", args.tickers))
+        timings["bizsval screen"], output = run(["bizsval.py", "screen", "gpw", *tickers, "--data-dir", f"{tmp}/gpw",
+                                                 "--no-blacklist"], env, args.repeat)
+    finally:
+        shutil.rmtree(tmp)
+
+    interpreter = timings["interpreter"]
+    for name, seconds in timings.items():
+        print(f"{name:16} {seconds * 1000:8.1f} ms  {(seconds - interpreter) * 1000:8.1f} ms over the interpreter")
+    share = (timings["import bizsval"] - interpreter) / (timings["eager imports"] - interpreter)
+    print(f"\nimport bizsval costs {share:.0%} of the eager imports ({', '.join(eager[1:])})")
+    print(f"screened {args.tickers} companies, {len(output.splitlines()) - 1} passed")
+    print(f"heavy modules loaded by import bizsval: {', '.join(loaded) or 'none'}")
+    return 1 if loaded else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+'''Load benchmark of the FinStore against the JSON files it replaces, run from the repository root:
+
+    python -m benchmarks.bench_store [--tickers 770] [--years 20] [--rows 40]
+
+Generates a biznesradar dataset with statements padded to "rows" rows (see benchmarks.synthetic),
+imports it into a temporary store and times prep_companies reading the files and reading the
+store (a fresh FinStore every time, so the query loading the whole source is included). Both have
+to give the same financials, the exit code is 1 if the store is not faster than the files'''
+from benchmarks.synthetic import br_dataset
+from bizsval import BrHandler, prep_companies
+from store import FinStore, import_br
+from instrument import log
+import logging
+import argparse
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+def best(func, repeat):
+    '''Best wall time of func over repeat runs and its last result'''
+    seconds = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return seconds, result
+
+def size(path):
+    if os.path.isdir(path):
+        return sum(e.stat().st_size for e in os.scandir(path))
+    return os.path.getsize(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load benchmark of the FinStore against the JSON files")
+    parser.add_argument("--tickers", type=int, default=770)
+    parser.add_argument("--years", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=40, help="rows of every statement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    log.setLevel(logging.CRITICAL) # companies without dividends would log errors
+
+    tmp = tempfile.mkdtemp()
+    try:
+        dir_ = f"{tmp}/gpw"
+        tickers = sorted(br_dataset(dir_, args.tickers, args.years, args.seed, rows=args.rows))
+        path = f"{tmp}/financials.db"
+        start = time.perf_counter()
+        store = FinStore(path)
+        import_br(store, dir_)
+        store.close()
+        imported = time.perf_counter() - start
+
+        def from_store():
+            store = FinStore(path)
+            try:
+                return prep_companies(BrHandler(dir_, store), tickers, None, use_black_list=False)
+            finally:
+                store.close()
+        files, expected = best(lambda: prep_companies(BrHandler(dir_), tickers, None, use_black_list=False), args.repeat)
+        stored, companies = best(from_store, args.repeat)
+        same = [c.financials.as_dict() for c in companies] == [c.financials.as_dict() for c in expected]
+        sizes = size(dir_), size(path)
+    finally:
+        shutil.rmtree(tmp)
+
+    print(f"{args.tickers} tickers, {args.years} years, statements padded to {args.rows} rows")
+    print(f"{'import':14} {imported:8.3f} s")
+    print(f"{'files':14} {files:8.3f} s  {sizes[0] / 2**20:8.1f} MB")
+    print(f"{'store':14} {stored:8.3f} s  {sizes[1] / 2**20:8.1f} MB  {stored / files:.2f}x the files")
+    if not same:
+        print("financials from the store differ from the files")
+    return 0 if same and stored < files else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import biznesradar_scraper as br
+import random
+import json
+import os
+
+ROW_LABELS = ["Przychody ze sprzedaży", "Techniczny koszt wytworzenia produkcji sprzedanej", "Koszty sprzedaży",
+              "Koszty ogólnego zarządu", "Zysk ze sprzedaży", "Pozostałe przychody operacyjne",
+              "Pozostałe koszty operacyjne", "Zysk operacyjny (EBIT)", "Przychody finansowe", "Koszty finansowe",
+              "Zysk przed opodatkowaniem", "Zysk netto", "Zysk netto akcjonariuszy jednostki dominującej",
+              "EBITDA", "Aktywa razem", "Kapitał własny akcjonariuszy jednostki dominującej", "Dywidenda"]
+
+def report_page(ticker, years=10, rows=40, seed=0, padding=200):
+    '''Synthetic biznesradar report page - box-left info table, report-table with rows of values
+    (some with year over year changes that are not parsed as values) and "padding" blocks of 
+    unrelated markup standing in for navigation, scripts and ads'''
+    rnd = random.Random(seed)
+    parts = ["<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>", ticker, "</title>"]
+    parts += [f"<script>var x{i} = {{a: {i}, b: '<div>'}};</script>" for i in range(padding // 10)]
+    parts.append("</head><body><div id=\"nav\"><ul>")
+    parts += [f"<li><a href=\"/spolka/{i}\">Spółka {i}</a></li>" for i in range(padding)]
+    parts.append("</ul></div><div class=\"box-left\"><table>")
+    info = {"Kapitalizacja:": f"{rnd.randint(10, 99999)} {rnd.randint(100, 999)} 000",
+            "Sektor:": "<a href=\"/sektor/x\">Przemysł</a>",
+            "Branża:": "<a href=\"/branza/y\">Budownictwo</a>",
+            "Liczba akcji:": f"{rnd.randint(1, 999)} 000 000",
+            "Rynek:": None}
+    for k, v in info.items():
+        parts.append(f"<tr><th>{k}</th><td>{v or '<span></span>'}</td></tr>")
+    parts.append("</table></div><table class=\"report-table\"><tr><th>Rok</th>")
+    parts += [f"<th>{2014 + y}</th>" for y in range(years)]
+    parts.append("</tr>")
+    labels = (ROW_LABELS + [f"Pozycja {i}" for i in range(rows)])[:rows]
+    for label in labels:
+        parts.append(f"<tr><td class=\"f\"><strong>{label}</strong></td>" if rnd.random() < 0.1 else f"<tr><td class=\"f\">{label}</td>")
+        for y in range(years):
+            value = rnd.randint(-10**6, 10**7)
+            change = f"<div class=\"changeyy\">r/r <span class=\"pv\">{rnd.randint(-99, 99)}%</span></div>" if y else ""
+            parts.append(f"<td class=\"h\"><span class=\"value\">{value:,}</span>{change}</td>".replace(",", " "))
+        parts.append("</tr>")
+    parts.append("</table>")
+    parts += [f"<div class=\"ad\"><p>Reklama {i}</p><img src=\"/i/{i}.png\"></div>" for i in range(padding // 4)]
+    parts.append("</body></html>")
+    return "".join(parts).encode("utf-8")
+
+EDGE_CASES = ("negative equity", "missing dividends", "losses", "short history")
+
+def financial_series(rnd, years, edge=None):
+    '''Yearly series of a plausible company - equity growing by retained earnings, edge is one of
+    EDGE_CASES or None. With "missing dividends" there is no dividend series at all'''
+    if edge == "short history":
+        years = min(years, 4)
+    equity = rnd.randint(100, 100000)
+    turnover = rnd.uniform(0.3, 3)
+    margin = rnd.uniform(0.01, 0.3)
+    payout = rnd.choice([0, 0, rnd.uniform(0.1, 0.9)])
+    series = {"equity": [], "net_income": [], "dividend": [], "revenue": [], "assets": [], "liabilities": []}
+    income = 0
+    for y in range(years):
+        revenue = equity * turnover * rnd.uniform(0.8, 1.25)
+        dividend = max(income, 0) * payout
+        income = revenue * margin * rnd.uniform(0.5, 1.5)
+        if edge == "losses" and y == years - 2:
+            income = -income
+        equity += income - dividend
+        liabilities = equity * rnd.uniform(0.2, 2)
+        series["equity"].append(round(equity))
+        series["net_income"].append(round(income))
+        series["dividend"].append(round(dividend))
+        series["revenue"].append(round(revenue))
+        series["assets"].append(round(equity + liabilities))
+        series["liabilities"].append(round(liabilities))
+    if edge == "negative equity":
+        series["equity"][-3] = -abs(series["equity"][-3])
+    if edge == "missing dividends":
+        del series["dividend"]
+    return series
+
+def dataset(count, years=10, seed=0, edge_rate=0.1):
+    '''Tickers, series and market caps of "count" synthetic companies, about edge_rate of them
+    are edge cases'''
+    rnd = random.Random(seed)
+    companies = {}
+    for i in range(count):
+        edge = rnd.choice(EDGE_CASES) if rnd.random() < edge_rate else None
+        series = financial_series(rnd, years, edge)
+        cap = max(series["net_income"][-1], 1) * rnd.uniform(3, 30)
+        companies[f"T{i:05}"] = (series, round(cap))
+    return companies
+
+def br_dataset(dir_, count, years=10, seed=0, edge_rate=0.1, rows=0):
+    '''Writes a synthetic dataset in the file layout of biznesradar_scraper (ticker-statement.json
+    files of the income statement, balance sheet and cash flow statement), returns a dict of 
+    ticker: market cap in thousands as BrHandler.get_market_cap. With rows, statements are padded
+    with unused rows of random values to that many rows, as scraped ones have about 40'''
+    os.makedirs(dir_, exist_ok=True)
+    rnd = random.Random(seed)
+    caps = {}
+    for ticker, (series, cap) in dataset(count, years, seed, edge_rate).items():
+        income = {br.REVENUE: series["revenue"], br.NET_INCOME: series["net_income"]}
+        balance = {"Aktywa razem": series["assets"], br.EQUITY: series["equity"]}
+        cash = {br.DIVIDEND: series["dividend"]} if "dividend" in series else {}
+        for statement, data in ((br.INCOME, income), (br.BALANCE, balance), (br.CASH, cash)):
+            for i in range(len(data), rows):
+                data[f"Pozycja {i}"] = [rnd.randint(-10**6, 10**7) for y in range(len(series["equity"]))]
+            with open(f"{dir_}/{ticker}-{statement}.json", 'w') as file:
+                json.dump(data, file)
+        caps[ticker] = cap
+    return caps
+
+def gf_dataset(dir_, count, years=5, seed=0, edge_rate=0.1):
+    '''Writes a synthetic dataset in the file layout of googlefinance_scraper (ticker.json with
+    market cap and P/E), missing dividends are zeros there as Google Finance dividends are derived
+    from equity changes. Returns a dict of ticker: market cap'''
+    os.makedirs(dir_, exist_ok=True)
+    caps = {}
+    for ticker, (series, cap) in dataset(count, years, seed, edge_rate).items():
+        series.setdefault("dividend", [0] * len(series["net_income"]))
+        # P/E in line with the market cap, GfHandler only rescales caps of mismatched ones
+        pe = cap / series["net_income"][4] if len(series["net_income"]) > 4 and series["net_income"][4] else "NaN"
+        with open(f"{dir_}/{ticker}.json", 'w') as file:
+            json.dump(dict(series, market_cap=cap, pe=pe), file)
+        caps[ticker] = cap
+    return caps
@@ -0,0 +1,176 @@
+import aiohttp
+import asyncio
+from contextlib import asynccontextmanager
+import random
+import json
+import time
+from urllib.parse import urlparse
+import biznesradar_scraper as br
+from biznesradar_scraper import INCOME, BALANCE, CASH, RATE, TIMEOUT, statement_url, parse_report, parse_info
+from instrument import METRICS, log
+
+CONCURRENCY = 8 # requests in flight at once
+RETRIES = 4
+BACKOFF = 1 # seconds before the first retry, doubled for every next one
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class AsyncTokenBucket:
+    '''asyncio counterpart of biznesradar_scraper.TokenBucket, waiting tasks do not block the loop'''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.last = time.monotonic()
+            self.tokens -= 1
+
+class Client:
+    '''Pooled aiohttp session for biznesradar, at most "concurrency" requests in flight and "rate"
+    requests per second per host. Requests failing with a connection error, a timeout or one of
+    RETRY_STATUSES are retried up to "retries" times with jittered exponential backoff, honoring
+    Retry-After. Pages go through the response cache of biznesradar_scraper, see use_cache.
+    Use as an async context manager'''
+    def __init__(self, concurrency=CONCURRENCY, rate=RATE, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiters = {}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def limiter(self, host):
+        if host not in self.limiters:
+            self.limiters[host] = AsyncTokenBucket(self.rate)
+        return self.limiters[host]
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def fetch(self, url):
+        '''Content of a page, raises aiohttp.ClientResponseError for error statuses that are
+        not retried or still failing after the last retry'''
+        if br.CACHE and br.REPLAY:
+            content = br.CACHE.get(url)
+            if content is None:
+                raise KeyError(f"{url} not in cache")
+            METRICS.count("replayed requests")
+            return content
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            async with self.semaphore:
+                await self.limiter(urlparse(url).netloc).acquire()
+                try:
+                    with METRICS.timer("request"):
+                        async with self.session.get(url) as response:
+                            METRICS.count("requests")
+                            METRICS.count(f"status {response.status}")
+                            if response.status not in RETRY_STATUSES or attempt == self.retries:
+                                response.raise_for_status()
+                                content = await response.read()
+                                METRICS.observe("response bytes", len(content))
+                                if br.CACHE:
+                                    br.CACHE.put(url, content)
+                                return content
+                            retry_after = response.headers.get("Retry-After")
+                            reason = f"status {response.status}"
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if attempt == self.retries:
+                        raise
+                    reason = f"{e.__class__.__name__}"
+            delay = self.delay(attempt, retry_after)
+            METRICS.count("retries")
+            log.info("retrying %s in %.1fs after %s", url, delay, reason)
+            await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def connect(client=None):
+    '''Yields the given Client or a new one closed on exit'''
+    if client is not None:
+        yield client
+    else:
+        async with Client() as client:
+            yield client
+
+async def parse(*args):
+    '''Runs a parser of biznesradar_scraper in a thread, so it does not stall other tasks'''
+    with METRICS.timer("parse wait"):
+        return await asyncio.to_thread(*args)
+
+async def get_info(ticker, client = None):
+    '''async biznesradar_scraper.get_info'''
+    log.info("getting info for %s", ticker)
+    async with connect(client) as client:
+        content = await client.fetch(f"https://www.biznesradar.pl/raporty-finansowe-bilans/{ticker}")
+    return await parse(parse_info, content)
+
+async def get_statement(ticker, statement, with_info = 0, client = None):
+    '''async biznesradar_scraper.get_statement, returns the statement and info dicts'''
+    log.info("getting %s for %s", statement, ticker)
+    async with connect(client) as client:
+        content = await client.fetch(statement_url(ticker, statement))
+    return await parse(parse_report, content, with_info)
+
+async def download_ticker(save_dir, ticker, statements_to_get = [INCOME, BALANCE, CASH], with_info = 0, client = None):
+    '''async biznesradar_scraper.download_ticker without the incremental mode, statements of a
+    ticker are fetched concurrently'''
+    async with connect(client) as client:
+        statements = await asyncio.gather(*[get_statement(ticker, statement, with_info and not i, client)
+                                            for i, statement in enumerate(statements_to_get)])
+    for statement, (data, inf) in zip(statements_to_get, statements):
+        with open(f"{save_dir}/{ticker}-{statement}.json", 'w') as f:
+            json.dump(data, f)
+        if inf:
+            with open(f"{save_dir}/{ticker}-info.json", 'w') as f:
+                json.dump(inf, f)
+    return ["updated"] * len(statements_to_get)
+
+async def bulk_download(save_dir, ticker_list, statements_to_get = [INCOME, BALANCE, CASH], with_info = 0,
+                        concurrency = CONCURRENCY, rate = RATE, client = None):
+    '''async biznesradar_scraper.bulk_download, returns a dict with "ok" or the error message for
+    every ticker. Cancelling it cancels all requests in flight'''
+    if client is None:
+        async with Client(concurrency, rate) as client:
+            return await bulk_download(save_dir, ticker_list, statements_to_get, with_info, client = client)
+
+    async def job(ticker):
+        try:
+            await download_ticker(save_dir, ticker, statements_to_get, with_info, client)
+            summary[ticker] = "ok"
+        except Exception as e:
+            summary[ticker] = f"{e.__class__.__name__}: {e}"
+            METRICS.count("failed tickers")
+            log.warning("failed to save financial statements for %s: %s", ticker, summary[ticker])
+
+    summary = {}
+    tasks = [asyncio.create_task(job(t)) for t in ticker_list]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    summary = {t: summary[t] for t in ticker_list}
+    failed = [t for t, status in summary.items() if status != "ok"]
+    log.info("saved %d/%d tickers, failed: %s", len(summary) - len(failed), len(summary), failed)
+    return summary
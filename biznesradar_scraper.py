@@ -1,7 +1,17 @@
-import requests
-from bs4 import BeautifulSoup
+from lazy import lazy_import
+from html_cache import ResponseCache, CachedResponse, HTML_CACHE, MAX_BYTES
+from instrument import METRICS, log
+from journal import run_tickers, RETRIES
+from urllib.parse import urlparse
+import threading
+import hashlib
 import json
 import time
+import os
+
+requests = lazy_import("requests") # the scraping libraries are loaded on first use, bizsval
+bs4 = lazy_import("bs4")           # only needs the constants below to read saved statements
+lxml_html = lazy_import("lxml.html")
 
 CASH = "przeplywy-pieniezne"
 INCOME = "rachunek-zyskow-i-strat"
@@ -11,10 +21,108 @@ NET_INCOME = "Zysk netto akcjonariuszy jednostki dominującej"
 REVENUE = "Przychody ze sprzedaży"
 SALES_INC = "Zysk ze sprzedaży"
 DIVIDEND = "Dywidenda"
+SECTOR = "Sektor:" # info box fields
+INDUSTRY = "Branża:"
+
+RATE = 3 # default polite request rate per host, requests per second
+TIMEOUT = 30
+POOL_SIZE = 16
+PARSER = "lxml" # report page parser - "lxml" or "html.parser" BeautifulSoup tree builders or "targeted"
+MANIFEST = "manifest.json"
+MAX_AGE = 7 * 24 * 3600 # seconds after which a cached statement is checked for changes again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    '''Thread safe rate limiter, lets through "rate" requests per second on average
+    with bursts of up to "capacity" requests'''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def make_session(pool_size=POOL_SIZE):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+SESSION = None
+LIMITERS = {}
+_limiters_lock = threading.Lock()
+_session_lock = threading.Lock()
+
+def get_session():
+    '''returns the shared session, made on first use'''
+    global SESSION
+    with _session_lock:
+        if SESSION is None:
+            SESSION = make_session()
+        return SESSION
+
+def get_limiter(host):
+    '''returns the shared rate limiter of a host, one bucket per host'''
+    with _limiters_lock:
+        if host not in LIMITERS:
+            LIMITERS[host] = TokenBucket(RATE)
+        return LIMITERS[host]
+
+def set_rate(host, rate, capacity=1):
+    limiter = get_limiter(host)
+    with limiter.lock:
+        limiter.rate = rate
+        limiter.capacity = capacity
+
+CACHE = None
+REPLAY = False
+
+def use_cache(dir_ = HTML_CACHE, max_bytes = MAX_BYTES, replay = False):
+    '''Stores every downloaded page in a ResponseCache, in replay mode pages are read from the 
+    cache instead of the network, so parsers can be rerun offline'''
+    global CACHE, REPLAY
+    CACHE = ResponseCache(dir_, max_bytes)
+    REPLAY = replay
+    return CACHE
+
+def fetch(url, headers=None):
+    '''rate limited GET over the shared keep-alive session'''
+    if CACHE and REPLAY:
+        content = CACHE.get(url)
+        if content is None:
+            raise KeyError(f"{url} not in cache")
+        METRICS.count("replayed requests")
+        return CachedResponse(url, content)
+    get_limiter(urlparse(url).netloc).acquire()
+    with METRICS.timer("request"):
+        response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    METRICS.count("requests")
+    METRICS.count(f"status {response.status_code}")
+    METRICS.observe("response bytes", len(response.content))
+    if CACHE and response.status_code == 200:
+        CACHE.put(url, response.content)
+    return response
+
+def make_soup(markup, parser = None):
+    parser = parser or PARSER
+    return bs4.BeautifulSoup(markup, "lxml" if parser == "targeted" else parser)
 
 def cook_soup(url):
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, "html.parser")
+    response = fetch(url)
+    soup = make_soup(response.content)
     return soup
 
 def get_tickers():
@@ -45,15 +153,16 @@ def extract_info(soup):
 def get_info(ticker):
     ''' gets you current market cap and misc info provided by biznesradar.pl'''
     URL = f"https://www.biznesradar.pl/raporty-finansowe-bilans/{ticker}"
-    response = requests.get(URL)
-    soup = BeautifulSoup(response.text, "html.parser")
-    print(f"getting info for {ticker}")
-    return extract_info(soup)
+    response = fetch(URL)
+    log.info("getting info for %s", ticker)
+    response.raise_for_status()
+    return parse_info(response.content)
       
-def get_statement(ticker, statement, with_info = 0):
-    '''scrape financial statement from biznesradar.pl'''
-    print(f"getting {statement} for {ticker}")
-    soup = cook_soup(f"https://www.biznesradar.pl/raporty-finansowe-{statement}/{ticker}")
+def statement_url(ticker, statement):
+    return f"https://www.biznesradar.pl/raporty-finansowe-{statement}/{ticker}"
+
+def parse_statement(soup, with_info = 0):
+    '''extracts rows of a financial statement (and optionally info) from a report page'''
     inf = {}
     if with_info:
         inf = extract_info(soup)
@@ -70,32 +179,216 @@ def get_statement(ticker, statement, with_info = 0):
             pass
     return data, inf
 
+def get_statement(ticker, statement, with_info = 0):
+    '''scrape financial statement from biznesradar.pl'''
+    log.info("getting %s for %s", statement, ticker)
+    response = fetch(statement_url(ticker, statement))
+    response.raise_for_status()
+    return parse_report(response.content, with_info)
+
+def has_class(name, axis = "descendant"):
+    return f"{axis}::*[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+
+def collapse(string):
+    '''BeautifulSoup replaces whitespace-only strings with a single space or newline'''
+    if string.strip(" \n\t\f\r"):
+        return string
+    return "\n" if "\n" in string else " "
+
+def node_string(element):
+    '''lxml equivalent of BeautifulSoup Tag.string - the text of an element with a single
+    child node, looked up recursively through single child elements, otherwise None'''
+    nodes = [element.text] if element.text else []
+    for child in element:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+    if len(nodes) != 1:
+        return None
+    if isinstance(nodes[0], str):
+        return collapse(nodes[0])
+    if not isinstance(nodes[0].tag, str): # comment
+        return collapse(nodes[0].text)
+    return node_string(nodes[0])
+
+def first(elements):
+    return elements[0] if elements else None
+
+def targeted_info(root):
+    '''extract_info working on the lxml tree'''
+    box = first(root.xpath(has_class("box-left", "descendant-or-self")))
+    data = {}
+    for i in box.iterdescendants("tr"):
+        temp = node_string(i.find(".//td"))
+        if temp:
+            data[node_string(i.find(".//th"))] = temp
+        else:
+            temp = i.find(".//td").find(".//a")
+            if temp is not None:
+                data[node_string(i.find(".//th"))] = node_string(temp)
+    return data
+
+def targeted_parse(markup, with_info = 0):
+    '''parse_statement working directly on an lxml tree, visits only report-table and box-left
+    instead of building a BeautifulSoup tree of the whole page, gives the same output'''
+    root = lxml_html.fromstring(markup)
+    inf = {}
+    if with_info:
+        inf = targeted_info(root)
+    table = first(root.xpath(has_class("report-table", "descendant-or-self")))
+    rows = table.iterdescendants("tr")
+    data = {}
+    for row in rows:
+        temp = []
+        try:
+            for i in row.xpath(has_class("value")):
+                temp.append(int(node_string(i).replace(" ", "")))
+                data[node_string(row.find(".//td"))] = temp
+        except:
+            pass
+    return data, inf
+
+def parse_report(markup, with_info = 0, parser = None):
+    '''parses a report page with the parser backend, see PARSER'''
+    parser = parser or PARSER
+    with METRICS.timer("parse"):
+        if parser == "targeted":
+            return targeted_parse(markup, with_info)
+        return parse_statement(make_soup(markup, parser), with_info)
+
+def parse_info(markup, parser = None):
+    parser = parser or PARSER
+    with METRICS.timer("parse"):
+        if parser == "targeted":
+            return targeted_info(lxml_html.fromstring(markup))
+        return extract_info(make_soup(markup, parser))
+
 def default_tickers():
     tickers = json.load(open("data/gpw_tickers.json"))
     return tickers
 
-def bulk_download(save_dir, ticker_list, statements_to_get = [INCOME, BALANCE, CASH], with_info = 0, request_delay = 1):
-    s = statements_to_get
-    for ticker in ticker_list:
-        try:
-            inf = None
-            for statement in s:
-                if not inf and with_info:
-                    temp = get_statement(ticker, statement, with_info = 1)
-                    statement_ =  temp[0]
-                    inf = temp[1]
-                else:
-                    statement_ = get_statement(ticker, statement, with_info = 1)[0]
-                with open(f"{save_dir}/{ticker}-{statement}.json", 'w') as f:
-                    json.dump(statement_, f)
-            
-            if inf:
-                with open(f"{save_dir}/{ticker}-info.json", 'w') as f:
-                    json.dump(inf, f)
-            
-            time.sleep(request_delay)
-        except:
-            print(f"failed to save financial statements for {ticker}")
+def load_manifest(save_dir):
+    '''manifest of cached statements - fetch time, content hash, ETag and Last-Modified
+    for every "{ticker}-{statement}" file in save_dir, fetch time for "{ticker}-info" files'''
+    try:
+        with open(f"{save_dir}/{MANIFEST}") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(save_dir, manifest):
+    temp = f"{save_dir}/{MANIFEST}.tmp"
+    with open(temp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp, f"{save_dir}/{MANIFEST}")
+
+def content_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def is_fresh(save_dir, key, manifest, now, max_age = MAX_AGE):
+    '''whether the "{key}.json" file in save_dir was fetched less than max_age seconds ago'''
+    entry = manifest.get(key)
+    return bool(entry) and now - entry["fetched"] < max_age and os.path.exists(f"{save_dir}/{key}.json")
+
+def refresh_statement(save_dir, ticker, statement, manifest, with_info = 0, max_age = MAX_AGE):
+    '''incremental counterpart of get_statement, skips statements fetched less than max_age 
+    seconds ago, sends a conditional request for older ones and rewrites the file only if 
+    its parsed content changed, returns the outcome and scraped info. Info is only scraped
+    if the saved one is older than max_age too, a stale info fetches even a fresh statement'''
+    key = f"{ticker}-{statement}"
+    path = f"{save_dir}/{key}.json"
+    entry = manifest.get(key) if os.path.exists(path) else None
+    now = time.time()
+    with_info = with_info and not is_fresh(save_dir, f"{ticker}-info", manifest, now, max_age)
+    if entry and now - entry["fetched"] < max_age and not with_info:
+        return "fresh", {}
+
+    headers = {}
+    if entry and entry.get("etag") and not with_info: # a 304 would come without the info box
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified") and not with_info:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    log.info("refreshing %s for %s", statement, ticker)
+    response = fetch(statement_url(ticker, statement), headers)
+    if response.status_code == 304:
+        manifest[key] = dict(entry, fetched = now)
+        return "not modified", {}
+    response.raise_for_status()
+
+    data, inf = parse_report(response.content, with_info)
+    hash_ = content_hash(data)
+    outcome = "unchanged"
+    if not entry or entry["hash"] != hash_:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        outcome = "updated"
+    manifest[key] = {"fetched": now,
+                     "hash": hash_,
+                     "etag": response.headers.get("ETag"),
+                     "last_modified": response.headers.get("Last-Modified")}
+    return outcome, inf
+
+def download_ticker(save_dir, ticker, statements_to_get = [INCOME, BALANCE, CASH], with_info = 0, manifest = None, max_age = MAX_AGE):
+    '''scrapes and saves statements of a single ticker, refreshes them incrementally if
+    a manifest is given, returns the list of outcomes per statement'''
+    inf = None
+    outcomes = []
+    for statement in statements_to_get:
+        if manifest is None:
+            statement_, temp = get_statement(ticker, statement, with_info = with_info and not inf)
+            with open(f"{save_dir}/{ticker}-{statement}.json", 'w') as f:
+                json.dump(statement_, f)
+            outcomes.append("updated")
+        else:
+            outcome, temp = refresh_statement(save_dir, ticker, statement, manifest, with_info and not inf, max_age)
+            outcomes.append(outcome)
+        if temp:
+            inf = temp
+
+    if inf:
+        with open(f"{save_dir}/{ticker}-info.json", 'w') as f:
+            json.dump(inf, f)
+        if manifest is not None:
+            manifest[f"{ticker}-info"] = {"fetched": time.time()}
+    return outcomes
+
+def transient(e):
+    '''connection errors, timeouts and 429/5xx responses are worth retrying'''
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code in RETRY_STATUSES
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+def bulk_download(save_dir, ticker_list, statements_to_get = [INCOME, BALANCE, CASH], with_info = 0, workers = 8, rate = RATE, 
+                  incremental = 0, max_age = MAX_AGE, retries = RETRIES, journal = None, quarantine = None):
+    '''downloads statements of many tickers concurrently, requests to biznesradar are shared by 
+    a pool of "workers" threads and capped at "rate" requests per second, returns a dict with 
+    "ok" or the error message for every ticker. With incremental set only stale or changed 
+    statements are downloaded and rewritten, see refresh_statement. Tickers failing on transient
+    errors are retried up to "retries" times, with a journal path the job can be resumed after
+    an interruption and tickers failing again and again are added to the quarantine blacklist,
+    see journal.run_tickers'''
+    set_rate("www.biznesradar.pl", rate)
+    if workers > POOL_SIZE:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        get_session().mount("https://", adapter)
+    
+    manifest = load_manifest(save_dir) if incremental else None
+    outcomes = {}
+    try:
+        summary, results = run_tickers(lambda t: download_ticker(save_dir, t, statements_to_get, with_info, manifest, max_age),
+                                       ticker_list, workers, transient, retries, journal = journal, quarantine = quarantine)
+    finally:
+        if manifest is not None:
+            save_manifest(save_dir, manifest)
+
+    for ticker_outcomes in results.values():
+        for outcome in ticker_outcomes:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            METRICS.count(f"statements {outcome}")
+    failed = [t for t, status in summary.items() if status != "ok"]
+    log.info("saved %d/%d tickers, failed: %s", len(summary) - len(failed), len(summary), failed)
+    log.info("statements: %s", outcomes)
+    return summary
 
 def get_all_statements(ticker):
     return (get_statement(ticker, INCOME),
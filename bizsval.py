@@ -1,13 +1,31 @@
 import biznesradar_scraper as br
 import googlefinance_scraper as gf
+from store import FinStore, STORE, source_name
+from instrument import METRICS, log, verbose
+from result_sink import ResultSink
+from journal import BLACKLIST, load_blacklist, add_to_blacklist # re-exported, the scrapers quarantine tickers with them
 import os
+import sys
+import math
+import csv
 import json
+import logging
+import argparse
+import hashlib
 from statistics import mean, stdev, variance, median
 from glob import glob
 from datetime import date
-import csv
+from collections import OrderedDict
+from array import array
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 
-BLACKLIST = "data/blacklist.json"
+MARKET_CAPS = "data/market_caps.json"
+MARKET_CAP_TTL = 24 * 3600
+RESULT_FIELDS = ["Name", "Undervaluation Factor", "ROE", "Margin", "ROE Deviation", "Debt to Assets"]
+SCREEN_FIELDS = ["Name", "ROE", "Margin", "ROE Deviation", "Debt to Assets"]
+FILTERS = {"gpw": (0.05, 0.08, 0.5, 5), "gf": (0.05, 0.08, 0.8, 5)} # margin, ROE, ROE deviation and years back filters of a source
 
 def acint(string):
     '''Converts scraped financial report numerical strings to integers
@@ -19,9 +37,13 @@ def sort_dict(dictionary):
     return sorted_dict
        
 class BrHandler:
-    '''Converts data scraped from biznesradar.pl to standard attributes of Company objects'''
-    def __init__(self, dir_):
+    '''Converts data scraped from biznesradar.pl to standard attributes of Company objects, 
+    reads financials from a FinStore instead of JSON files if one is given'''
+    caps_with_financials = False # market caps are scraped separately
+    def __init__(self, dir_, store=None):
         self.dir = dir_  
+        self.store = store
+        self.source = source_name(dir_)
         
     def refine_financials(self, raw_financials):
         financials = {}
@@ -30,28 +52,44 @@ class BrHandler:
         financials['net_income'] = raw_financials[br.NET_INCOME]
         financials['revenue'] = raw_financials[br.REVENUE]
         financials['assets'] = raw_financials["Aktywa razem"]
-        financials['liabilities'] = [a - e for a, e in zip(financials['assets'], financials['equity'] )]
             
-        return financials
+        return Financials(financials) # liabilities are derived from assets and equity
     
     def get_financials(self, name, from_file):
-        if from_file:
-            S = (br.INCOME, br.BALANCE, br.CASH)
-            temp_financials = {}
-            for i in range (3):
-                with open(f"{self.dir}/{name}-{S[i]}.json") as file:
-                    data = json.load(file)
-                    temp_financials.update(data)      
-        return self.refine_financials(temp_financials)
+        with METRICS.timer("load"):
+            if self.store:
+                return self.refine_financials(self.store.get(self.source, name))
+            if from_file:
+                S = (br.INCOME, br.BALANCE, br.CASH)
+                temp_financials = {}
+                for i in range (3):
+                    with open(f"{self.dir}/{name}-{S[i]}.json") as file:
+                        data = json.load(file)
+                        temp_financials.update(data)      
+            return self.refine_financials(temp_financials)
     
     def get_market_cap(self, name, from_file):
         if not from_file:
             return acint(br.get_info(name)["Kapitalizacja:"])/1000
+
+    def get_sector(self, name, field=br.SECTOR):
+        '''Sector of a company (industry with field=br.INDUSTRY) from its saved info box, None if unknown'''
+        if self.store:
+            return self.store.get(self.source, name).get(field)
+        try:
+            with open(f"{self.dir}/{name}-info.json") as file:
+                return json.load(file).get(field)
+        except FileNotFoundError:
+            return None
         
 class GfHandler:
-    '''Converts data scraped from Google Finance to standard attributes of Company objects'''
-    def __init__(self, dir_):
+    '''Converts data scraped from Google Finance to standard attributes of Company objects,
+    reads financials from a FinStore instead of JSON files if one is given'''
+    caps_with_financials = True # market caps come with the financials
+    def __init__(self, dir_, store=None):
         self.dir_ = dir_
+        self.store = store
+        self.source = source_name(dir_)
         self.market_caps = {}
     
     def adjust_market_cap(self, pe, market_cap, income):
@@ -65,11 +103,16 @@ class GfHandler:
                   
     def get_financials(self, name, from_file):
         fins = None
-        if from_file:
-            with open(f"{self.dir_}/{name}.json") as file:
+        if from_file and self.store:
+            with METRICS.timer("load"):
+                fins = self.store.get(self.source, name)
+        elif from_file:
+            with METRICS.timer("load"), open(f"{self.dir_}/{name}.json") as file:
                 fins = json.load(file)
         else:
             fins = gf.get_financials(name, dir_ = self.dir_)
+            if self.store:
+                self.store.put(self.source, name.replace(":", "-"), fins)
         if not fins['pe'] == "NaN":
             self.market_caps[name] = self.adjust_market_cap(fins['pe'], fins['market_cap'], fins["net_income"])
         return fins
@@ -84,6 +127,10 @@ class GfHandler:
                 return 0
             return cap
 
+    def get_sector(self, name, field=None):
+        '''Google Finance data has no sectors'''
+        return None
+
 class EquityError(Exception):
     def __init__(self, message):
        super().__init__(message)
@@ -98,21 +145,137 @@ class MarketCapError(Exception):
     def __str__(self):
         return f"{self.__class__.__name__}"
 
+class Financials:
+    '''Compact container of the financial series of a company, all of them are kept as floats in one
+    array with their end offsets in another, indexing by field returns a memoryview of the series.
+    Liabilities not given explicitly are derived from assets - equity on access'''
+    FIELDS = ("equity", "net_income", "dividend", "revenue", "assets", "liabilities")
+    __slots__ = ("buffer", "ends", "derived")
+
+    def __init__(self, series=None):
+        series = series or {}
+        self.buffer = array('d')
+        self.ends = array('I')
+        for field in self.FIELDS:
+            self.buffer.extend(series.get(field, ()))
+            self.ends.append(len(self.buffer))
+        self.derived = "liabilities" not in series
+
+    def __getitem__(self, field):
+        if field == "liabilities" and self.derived:
+            return array('d', [a - e for a, e in zip(self["assets"], self["equity"])])
+        try:
+            i = self.FIELDS.index(field)
+        except ValueError:
+            raise KeyError(field)
+        start = self.ends[i - 1] if i else 0
+        return memoryview(self.buffer)[start:self.ends[i]]
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(field, self[field]) for field in self.FIELDS]
+
+    def as_dict(self):
+        return {field: self[field].tolist() for field in self.FIELDS}
+
+    def digest(self):
+        '''Hash of the series, equal for equal financials'''
+        h = hashlib.sha1(self.buffer.tobytes())
+        h.update(self.ends.tobytes())
+        h.update(b"derived" if self.derived else b"")
+        return h.hexdigest()
+
+def window(financials, years_back=None, i1=None, i2=None, field="net_income"):
+    '''Resolves the years_back or i1, i2 arguments of metrics into the i1, i2 window of a field'''
+    if years_back:
+        i2 = len(financials[field])
+        i1 = i2 - years_back
+    if i1 is None or i2 is None:
+        raise ValueError("i1 and i2 must be defined")
+    return i1, i2
+
+def roe_stats(financials, i1, i2):
+    '''Mean return on equity in years i1 to i2 and its standard deviation relative to the mean'''
+    roes = []
+    equity = financials["equity"]
+    net_income = financials["net_income"]
+    for i in range(i1, i2):
+        if equity[i] <= 0:
+            raise ValueError("negative equity")
+        else:
+            if net_income[i] == 0:
+                roes.append(0)
+            else:
+                roes.append(net_income[i] / equity[i])
+    roe = mean(roes)
+    return roe, stdev(roes) / roe
+
+def payout_ratio(financials, i1, i2):
+    '''Mean dividend payout ratio in years i1 to i2, dividends are paid out of previous year's income'''
+    prs = []
+    for i in range(i1, i2):
+        inc = financials["net_income"][i - 1]
+        div = financials["dividend"][i]
+        if inc > 0:
+            prs.append(div / inc)
+    if len(prs) > 1:
+        return mean(prs)
+    else:
+        return 0
+
+def net_margin(financials, i1, i2):
+    '''Mean net margin in years i1 to i2'''
+    return mean([financials["net_income"][i] / financials["revenue"][i] for i in range(i1, i2)])
+
+def mean_income(financials, i1, i2):
+    '''Mean net income in years i1 to i2'''
+    return mean(financials["net_income"][i1:i2])
+
+def all_positive(financials, i1, i2, field):
+    '''Checks if all values of a field are positive in years i1 to i2'''
+    return all(val > 0 for val in financials[field][i1:i2])
+
+WINDOW_METRICS = {
+    "roe": roe_stats,
+    "payout ratio": payout_ratio,
+    "margin": net_margin,
+    "income": mean_income,
+    "positive": all_positive
+}
+
 class Company:
     '''Main class for representing companies to be evaluated, parameter "name" has to match the file
     in which data is stored, by default exchange ticker. Handler depends on the source of data. GfHandler 
-    for companies sourced from Google Finance, BrHandler for biznesradar.pl'''
-    def __init__(self, name, handler):
+    for companies sourced from Google Finance, BrHandler for biznesradar.pl. Companies of a Universe
+    load their financials on first access. Financials are stored as Financials, dicts of lists are 
+    converted on assignment. Metrics over a window of years are computed once by the functions
+    of WINDOW_METRICS and kept until the financials change, see metric'''
+    __slots__ = ("name", "handler", "universe", "_financials", "_metrics", "market_cap", "known_years",
+                 "roe", "roe_deviation", "margin", "debt_to_equity", "debt_to_assests")
+
+    def __init__(self, name, handler, universe=None):
         self.name = name
         self.handler = handler
-        self.financials = {
-            "equity": [],
-            "net_income": [],
-            "dividend": [],
-            "revenue": [],
-            "assets": [],
-            "liabilities": []
-        }
+        self.universe = universe
+        self._financials = None if universe else Financials()
+        self._metrics = {}
         self.market_cap = 0
         self.known_years = 0
         self.roe = 0
@@ -121,84 +284,66 @@ class Company:
         self.debt_to_equity = 0
         self.debt_to_assests = 0
 
+    @property
+    def financials(self):
+        if self._financials is None:
+            self.financials = self.handler.get_financials(self.name, 1)
+            if self.universe:
+                self.universe.touch(self)
+        return self._financials
+
+    @financials.setter
+    def financials(self, value):
+        self._financials = value if isinstance(value, Financials) else Financials(value)
+        self._metrics = {}
+
+    def unload(self):
+        '''Drops financials from memory, they are loaded again on next access'''
+        self._financials = None
+        self._metrics = {}
+
+    def metric(self, name, i1, i2, *args):
+        '''Value of the metric function WINDOW_METRICS[name] in years i1 to i2, cached per window'''
+        financials = self.financials
+        key = (name, i1, i2) + args
+        if key not in self._metrics:
+            self._metrics[key] = WINDOW_METRICS[name](financials, i1, i2, *args)
+        return self._metrics[key]
+
     def chk_pos(self, element_of_financials, years_back=None, i1=None, i2=None): 
         '''Checks if all elements of a financial statement's section are positive'''
-        if years_back:
-            i2 = len(self.financials[element_of_financials])
-            i1 = i2 - years_back
-        if i1 is None or i2 is None:
-            raise ValueError("i1 and i2 must be defined")
-        return all(val > 0 for val in self.financials[element_of_financials][i1:i2])
+        i1, i2 = window(self.financials, years_back, i1, i2, element_of_financials)
+        return self.metric("positive", i1, i2, element_of_financials)
 
     def mean_roe(self, years_back=None, i1=None, i2=None): 
         '''Calculates mean return on equity in given years'''
-        roes = []
-        if years_back:
-            i2 = len(self.financials['net_income'])
-            i1 = i2 - years_back
-        if i1 is None or i2 is None:
-            raise ValueError("i1 and i2 must be defined")
-        for i in range(i1, i2):
-            equity = self.financials["equity"]
-            net_income = self.financials['net_income']
-            if equity[i] <= 0:
-                raise ValueError("negative equity")
-            else:
-                if net_income[i] == 0:
-                    roes.append(0)
-                else:
-                    roes.append(net_income[i] / equity[i])
-        self.roe = mean(roes)
-        self.roe_deviation = stdev(roes) / self.roe
+        i1, i2 = window(self.financials, years_back, i1, i2)
+        self.roe, self.roe_deviation = self.metric("roe", i1, i2)
         return self.roe
 
     def mean_pr(self, years_back=None, i1=None, i2=None): 
         '''Calculates mean payout ratio in given years'''
-        prs = []
-        if years_back:
-            i2 = len(self.financials['net_income'])
-            i1 = i2 - years_back
-        if i1 is None or i2 is None:
-            raise ValueError("i1 and i2 must be defined")
-        for i in range(i1, i2):
-            inc = self.financials["net_income"][i - 1]
-            div = self.financials["dividend"][i]
-            if inc > 0:
-                prs.append(div / inc)
-        if len(prs) > 1:
-            return mean(prs)
-        else:
-            return 0
+        i1, i2 = window(self.financials, years_back, i1, i2)
+        return self.metric("payout ratio", i1, i2)
 
     def estimate_growth(self, years_back=None, i1=None, i2=None):
         '''Default method to estimate earnings growth, assuming additions to capital
         based on mean dividend payout ratio and returns equal to mean ROE'''
-        if years_back:
-            i2 = len(self.financials['net_income'])
-            i1 = i2 - years_back
-        if i1 is None or i2 is None:
-            raise ValueError("i1 and i2 must be defined")
+        i1, i2 = window(self.financials, years_back, i1, i2)
         roe = self.mean_roe(i1=i1, i2=i2)
         pr = self.mean_pr(i1=i1, i2=i2)
         if pr < 0 or roe < 0 or pr > 1:
-            print(f"{self.name} assuming no growth \n payout ratio : {pr}, roe : {roe}")
+            log.debug("%s assuming no growth, payout ratio : %s, roe : %s", self.name, pr, roe)
             return 0
         else:
-            print(f"{self.name} estimated growth rate {roe * (1 - pr)}")
+            log.debug("%s estimated growth rate %s", self.name, roe * (1 - pr))
             return roe * (1 - pr)
 
     def calc_margin(self, years_back=None, i1=None, i2=None):
         '''Calculates mean net margin of a Company'''
-        margins = []
-        if years_back:
-            i2 = len(self.financials['net_income'])
-            i1 = i2 - years_back
-        if i1 is None or i2 is None:
-            raise ValueError("i1 and i2 must be defined")
-        for i in range(i1, i2):
-            margins.append(self.financials["net_income"][i] / self.financials['revenue'][i])
-        self.margin = mean(margins)
-        return mean(margins)
+        i1, i2 = window(self.financials, years_back, i1, i2)
+        self.margin = self.metric("margin", i1, i2)
+        return self.margin
     
     def calc_debt_to_equity_current(self):
         self.debt_to_equity = self.financials['liabilities'][-1] / self.financials['equity'][-1]
@@ -218,14 +363,13 @@ class Company:
         gr = self.estimate_growth(i1=i1_, i2=i2_)
         if gr > growth_cap:
             gr = growth_cap
-        income = mean(self.financials['net_income'][i1_:i2_])
-        print(f"mean income {income}")
-        print(f"growth rate {gr}")
+        income = self.metric("income", i1_, i2_)
+        log.debug("%s mean income %s, growth rate %s", self.name, income, gr)
         incomes = []
         for i in range(projection_length):
             income *= 1 + gr 
             incomes.append(income / (1 + ((i + 1) * 0.03)))
-        print(f"projecetd incomes {incomes}")
+        log.debug("%s projected incomes %s", self.name, incomes)
         return incomes
 
     def estimate_income_nc(self, base_i0, base_i1, projection_length):
@@ -247,7 +391,7 @@ class Company:
         return iv 
 
     def calc_iv2(self): 
-        print(f"calculating iv for {self.name}")
+        log.debug("calculating iv for %s", self.name)
         l = len(self.financials["net_income"])
         if self.roe == 0:
             self.mean_roe(years_back=l)
@@ -260,7 +404,7 @@ class Company:
             return 0, 0
         else:
             gr = roe * (1 - pr)
-            print(f"assumed growth rate {gr}")
+            log.debug("%s assumed growth rate %s", self.name, gr)
             inc = 0
             for i in range(1, 11):
                 temp = equity * roe
@@ -270,15 +414,21 @@ class Company:
             inc += temp / 0.1
             return inc, gr
 
-    def calc_uvf(self, discount_rate, yearsBack): 
+    def calc_uvf(self, discount_rate, yearsBack, projection_length=5, growth_cap=0.1, terminal_growth=0.02): 
         '''Calculates the undervaluation factor - intrinsic value / market price'''
         if not self.financials['equity']:
             raise EquityError("Missing equity data")
         if self.market_cap == 0:
             raise MarketCapError('Missing equity data')
-        iv = self.calc_iv(discount_rate, self.estimate_income_classic(5, 0.1, years_back=yearsBack), 0.02)
+        iv = self.intrinsic_value(discount_rate, yearsBack, projection_length, growth_cap, terminal_growth)
         return iv / self.market_cap
 
+    def intrinsic_value(self, discount_rate, yearsBack, projection_length=5, growth_cap=0.1, terminal_growth=0.02):
+        '''Intrinsic value used by calc_uvf, projected with estimate_income_classic'''
+        if not self.financials['equity']:
+            raise EquityError("Missing equity data")
+        return self.calc_iv(discount_rate, self.estimate_income_classic(projection_length, growth_cap, years_back=yearsBack), terminal_growth)
+
     def set_market_cap(self, from_file=0):
         self.market_cap = self.handler.get_market_cap(self.name, from_file)
 
@@ -292,17 +442,6 @@ def load_gf_tickers():
         tickers.append(t.replace(":","-"))
     return tickers
         
-def load_blacklist(dir_):
-    with open(dir_, 'r') as blacklist:
-        return json.load(blacklist)
-
-def add_to_blacklist(company, dir_):
-    _list = load_blacklist(dir_)
-    with open(dir_, 'w') as blacklist:
-        if company not in _list: 
-            _list.append(company)
-        json.dump(_list, blacklist)
-
 def prep_companies(handler, tickers, blacklist_dir, use_black_list=True):
     '''Initializes Company objects from saved data'''
     blacklist = []
@@ -317,82 +456,666 @@ def prep_companies(handler, tickers, blacklist_dir, use_black_list=True):
                 temp.set_financials()
                 companies.append(temp)
             else:
-                print(f"Blacklisted ticker: {t} - initialization skipped")
+                METRICS.count("blacklisted")
+                log.info("Blacklisted ticker: %s - initialization skipped", t)
         except Exception as e:
-            print(f"An error occurred while initializing company: {t} : {e}")
-            print("***************************")
+            METRICS.count("load errors")
+            log.warning("An error occurred while initializing company: %s : %s", t, e)
 
     return companies
 
-def eval_stocks(companies, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, use_black_list, blacklist_dir):
-    '''Runs the evaluation process for a list of company objects with filter parameters excluding
-    those not matching the given thresholds from valuation'''
-    
-    results = []  # List to store company data
+class Universe:
+    '''Lazily initialized companies of a list of tickers. Iterating yields Company objects one by one,
+    their financials are loaded on first access and only the "cache_size" most recently loaded
+    companies keep them in memory'''
+    def __init__(self, handler, tickers, blacklist_dir=BLACKLIST, use_black_list=True, cache_size=256):
+        self.handler = handler
+        self.tickers = tickers
+        self.blacklist_dir = blacklist_dir
+        self.use_black_list = use_black_list
+        self.cache_size = cache_size
+        self.loaded = OrderedDict()
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __iter__(self):
+        blacklist = load_blacklist(self.blacklist_dir) if self.use_black_list else []
+        for t in self.tickers:
+            if t in blacklist:
+                METRICS.count("blacklisted")
+                log.info("Blacklisted ticker: %s - initialization skipped", t)
+            else:
+                yield self.company(t)
+
+    def company(self, ticker):
+        if ticker in self.loaded:
+            self.loaded.move_to_end(ticker)
+            return self.loaded[ticker]
+        return Company(ticker, self.handler, self)
+
+    def touch(self, company):
+        '''Marks a company as recently used, unloads the least recently used ones over cache_size'''
+        self.loaded[company.name] = company
+        self.loaded.move_to_end(company.name)
+        while len(self.loaded) > self.cache_size:
+            name, old = self.loaded.popitem(last=False)
+            old.unload()
+
+def exclusion_reason(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+    '''Reason of excluding a company from valuation by the filters of eval_stocks, None if it passes'''
+    if not c.chk_pos("net_income", years_back=5):
+        return "negative earnings present"
+    if margin_filter and c.calc_margin(years_back=filter_backyears) < margin_filter:
+        return "margin filter not passed"
+    if roe_filter:
+        roe, deviation = c.metric("roe", *window(c.financials, filter_backyears))
+        if roe < roe_filter:
+            return "ROE filter not passed"
+        if roe_deviation_filter and deviation > roe_deviation_filter:
+            return "ROE deviation filter not passed"
+    return None
+
+def screen_company(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+    '''exclusion_reason that logs and counts the reason of exclusion'''
+    with METRICS.timer("filter"):
+        reason = exclusion_reason(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears)
+    if reason:
+        METRICS.count(f"excluded: {reason}")
+        log.info("%s excluded from valuation, reason: %s", c.name, reason)
+    else:
+        METRICS.count("passed filters")
+    return reason
+
+def passes_filters(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+    '''Checks a company against the filters of eval_stocks, logs and counts the reason of exclusion'''
+    return screen_company(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears) is None
+
+def result_metrics(c, margin_years=0, years_back=5):
+    '''ROE and its deviation over the valuation window and margin over the filter window (0 if
+    margins were not filtered) reported with a valuation, independent of earlier calls on c'''
+    roe, deviation = c.metric("roe", *window(c.financials, years_back))
+    margin = c.metric("margin", *window(c.financials, margin_years)) if margin_years else 0
+    return roe, margin, deviation
+
+def value_company(c, discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02, margin_years=0):
+    '''Result row of eval_stocks for a company with its market cap set, margin_years is 
+    the margin filter window, see result_metrics'''
+    with METRICS.timer("valuation"):
+        uvf = c.calc_uvf(discount_rate, 5, projection_length, growth_cap, terminal_growth)  # Undervaluation factor
+        roe, margin, deviation = result_metrics(c, margin_years)
+        debt_to_assets = c.calc_debt_to_assets_current()
+    METRICS.count("valued")
+    return {
+        "Name": c.name,
+        "Undervaluation Factor": uvf,
+        "ROE": roe,
+        "Margin": margin,
+        "ROE Deviation": deviation,
+        "Debt to Assets": debt_to_assets
+    }
+
+def screen_stocks(companies, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+    '''Yields rows of SCREEN_FIELDS for companies passing the filters of eval_stocks, works offline
+    as no market caps are needed'''
     for c in companies:
         try:
-            exclusion = False
-            while exclusion == False:
-                if not c.chk_pos("net_income", years_back=5):
-                    exclusion = True
-                    print(f"{c.name} excluded from valuation, reason: negative earnings present")
-                    break
-                if margin_filter:
-                    if c.calc_margin(years_back=filter_backyears) < margin_filter:
-                        print(f"{c.name} excluded from valuation, reason: margin filter not passed")
-                        exclusion = True
-                        break
-                if roe_filter:
-                    if c.mean_roe(years_back=filter_backyears) < roe_filter:
-                        exclusion = True
-                        print(f"{c.name} excluded from valuation, reason: ROE filter not passed")
-                if roe_deviation_filter:
-                    if c.roe_deviation > roe_deviation_filter:
-                        exclusion = True
-                        print(f"{c.name} excluded from valuation, reason: ROE deviation filter not passed")
-                        break
-                
-                break
-
-            if not exclusion:
-                c.set_market_cap()
-                uvf = c.calc_uvf(discount_rate=0.065, yearsBack=5)  # Undervaluation factor
-                roe = c.roe
-                margin = c.margin
-                deviation = c.roe_deviation
-                debt_to_assets = c.calc_debt_to_assets_current()
-                results.append({
+            if passes_filters(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+                roe, margin, deviation = result_metrics(c, filter_backyears if margin_filter else 0)
+                yield {
                     "Name": c.name,
-                    "Undervaluation Factor": uvf,
                     "ROE": roe,
                     "Margin": margin,
                     "ROE Deviation": deviation,
-                    "Debt to Assets": debt_to_assets
-                })
-            br.time.sleep(1)
-            print("***************************")
+                    "Debt to Assets": c.calc_debt_to_assets_current()
+                }
+        except Exception as e:
+            METRICS.count("errors")
+            log.warning("An error occurred while screening %s: %s", c.name, e)
+
+def peer_screen_stocks(companies, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, peer_filters=(),
+                       sector_field=br.SECTOR):
+    '''screen_stocks with filters relative to the sector of a company (see Screener.peer_screen) for a
+    list of loaded companies, rows have SCREEN_FIELDS and the peer_fields columns of OFFLINE_PEER_METRICS.
+    Offline there are no market caps, so undervaluation factor peer filters raise a ValueError'''
+    from screener import Screener, OFFLINE_PEER_METRICS
+    for metric, *_ in peer_filters:
+        if metric not in OFFLINE_PEER_METRICS:
+            raise ValueError(f"{metric} peer filters need market caps, see batch_eval_stocks")
+    screener = Screener(companies)
+    screener.set_sectors(load_sectors(companies, sector_field))
+    passed = screener.screen(margin_filter, roe_filter, roe_deviation_filter, filter_backyears)
+    if peer_filters:
+        passed &= screener.peer_screen(peer_filters, filter_backyears)
+    stats = screener.peer_stats(filter_backyears)
+    roe, deviation = screener.mean_roe(5)
+    margin = screener.calc_margin(filter_backyears)
+    debt_to_assets = screener.calc_debt_to_assets_current()
+    for i in passed.nonzero()[0]:
+        if any(math.isnan(x[i]) for x in (roe, deviation, debt_to_assets)):
+            continue
+        row = {
+            "Name": screener.names[i],
+            "ROE": float(roe[i]),
+            "Margin": float(margin[i]) if margin_filter else 0,
+            "ROE Deviation": float(deviation[i]),
+            "Debt to Assets": float(debt_to_assets[i])
+        }
+        row.update(screener.peer_row(i, stats, OFFLINE_PEER_METRICS))
+        yield row
+
+def parse_peer_filter(text):
+    '''Peer filter of Screener.peer_screen from {metric}_{stat}_{min|max}={value}, e.g. roe_percentile_min=50'''
+    name, _, value = text.partition("=")
+    rest, _, end = name.rpartition("_")
+    metric, _, stat = rest.rpartition("_")
+    if end not in ("min", "max") or stat not in ("median", "percentile", "z") or metric not in ("roe", "margin", "debt_to_assets", "uvf"):
+        raise ValueError(f"invalid peer filter {text}")
+    value = float(value)
+    return (metric, stat, value, None) if end == "min" else (metric, stat, None, value)
+
+def eval_stocks(companies, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, use_black_list, blacklist_dir,
+                discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02, workers=8, market_cap_cache=MARKET_CAPS,
+                chunk_size=64, batch_size=64, parquet=False):
+    '''Runs the evaluation process for a list (or Universe) of company objects with filter parameters excluding
+    those not matching the given thresholds from valuation. Companies are processed in chunks of chunk_size, 
+    market caps are fetched for each chunk in a separate stage only for companies that passed the 
+    filters, see fetch_market_caps. Results are written as they come in batches of batch_size, with 
+    parquet set also to a Parquet file with the yearly inputs, see ResultSink'''
+    with ResultSink(result_path(save_dir, tag), RESULT_FIELDS, batch_size, parquet) as sink:
+        eval_chunks(sink, companies, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, 
+                    discount_rate, projection_length, growth_cap, terminal_growth, workers, market_cap_cache, chunk_size)
+
+def eval_chunks(sink, companies, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, discount_rate,
+                projection_length, growth_cap, terminal_growth, workers, market_cap_cache, chunk_size):
+    '''Filters and values companies chunk by chunk for eval_stocks, adding results to the sink'''
+    companies = iter(companies)
+    while True:
+        chunk = list(islice(companies, chunk_size))
+        if not chunk:
+            break
+        passed = []
+        for c in chunk:
+            try:
+                if passes_filters(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+                    passed.append(c)
+            except Exception as e:
+                METRICS.count("errors")
+                log.warning("An error occurred while evaluating %s: %s", c.name, e)
+
+        market_caps = fetch_market_caps(passed, workers, market_cap_cache)
+
+        for c in passed:
+            if c.name not in market_caps:
+                continue
+            try:
+                sink.add(value_company(c, discount_rate, projection_length, growth_cap, terminal_growth,
+                                       filter_backyears if margin_filter else 0), c.financials)
+            except Exception as e:
+                METRICS.count("errors")
+                log.warning("An error occurred while evaluating %s: %s", c.name, e)
+
+def revalue(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, discount_rate, projection_length,
+            growth_cap, terminal_growth):
+    '''Filters and values a company without its market cap for incremental_eval_stocks, returns the 
+    valuation as stored in a FinStore - status "valued", "excluded: reason" or "error: message"'''
+    valuation = {"status": "valued", "intrinsic_value": None, "uvf": None, "roe": None, "margin": None,
+                 "roe_deviation": None, "debt_to_assets": None}
+    try:
+        reason = screen_company(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears)
+        if reason:
+            valuation["status"] = f"excluded: {reason}"
+            return valuation
+        with METRICS.timer("valuation"):
+            iv = c.intrinsic_value(discount_rate, 5, projection_length, growth_cap, terminal_growth)
+            roe, margin, deviation = result_metrics(c, filter_backyears if margin_filter else 0)
+            debt_to_assets = c.calc_debt_to_assets_current()
+        METRICS.count("valued")
+        valuation.update(intrinsic_value=iv, roe=roe, margin=margin, roe_deviation=deviation, debt_to_assets=debt_to_assets)
+    except Exception as e:
+        METRICS.count("errors")
+        log.warning("An error occurred while evaluating %s: %s", c.name, e)
+        valuation["status"] = f"error: {e}"
+    return valuation
+
+def incremental_eval_stocks(companies, store, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears,
+                            discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02, workers=8,
+                            market_cap_cache=MARKET_CAPS, day=None, batch_size=64):
+    '''eval_stocks that keeps a dated snapshot of every company in a FinStore and only filters and values
+    companies whose financials changed since their last valuation with the same parameters. The filter 
+    outcome and intrinsic value of the others are carried forward, their undervaluation factor is 
+    updated with the current market cap. Writes the same results as eval_stocks, see FinStore.uvf_history'''
+    day = day or str(date.today())
+    params = json.dumps([margin_filter, roe_filter, roe_deviation_filter, filter_backyears, discount_rate, 
+                         projection_length, growth_cap, terminal_growth])
+    latest = {}
+    evaluated = []
+    for c in companies:
+        source = c.handler.source
+        if source not in latest:
+            latest[source] = store.latest_valuations(source, params)
+        try:
+            hash_ = c.financials.digest()
+        except Exception as e:
+            METRICS.count("load errors")
+            log.warning("An error occurred while initializing company: %s : %s", c.name, e)
+            continue
+        last = latest[source].get(c.name)
+        if last and last["hash"] == hash_:
+            METRICS.count("carried forward")
+            valuation = {k: last[k] for k in ("status", "intrinsic_value", "roe", "margin", "roe_deviation", "debt_to_assets")}
+            valuation["uvf"] = None
+        else:
+            METRICS.count("revalued")
+            valuation = revalue(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, discount_rate,
+                                projection_length, growth_cap, terminal_growth)
+            store.put_version(hash_, c.financials.as_dict())
+        evaluated.append((c, source, hash_, valuation))
+
+    market_caps = fetch_market_caps([c for c, _, _, v in evaluated if v["status"] == "valued"], workers, market_cap_cache)
+    with ResultSink(result_path(save_dir, tag), RESULT_FIELDS, batch_size) as sink:
+        for c, source, hash_, valuation in evaluated:
+            cap = market_caps.get(c.name)
+            if valuation["status"] == "valued":
+                if cap:
+                    valuation["uvf"] = valuation["intrinsic_value"] / cap
+                    sink.add({
+                        "Name": c.name,
+                        "Undervaluation Factor": valuation["uvf"],
+                        "ROE": valuation["roe"],
+                        "Margin": valuation["margin"],
+                        "ROE Deviation": valuation["roe_deviation"],
+                        "Debt to Assets": valuation["debt_to_assets"]
+                    })
+                elif c.name in market_caps:
+                    METRICS.count("errors")
+                    log.warning("An error occurred while evaluating %s: missing market cap", c.name)
+            store.put_snapshot(source, c.name, day, hash_, cap, dict(valuation, params=params))
+    store.commit()
+
+def result_path(save_dir, tag):
+    '''Path of the results of a run without the extension'''
+    return f"{save_dir}/{tag} {str(date.today())}"
+
+def save_results(results, save_dir, tag, fields=RESULT_FIELDS):
+    with ResultSink(result_path(save_dir, tag), fields, batch_size=len(results) or 1) as sink:
+        for r in results:
+            sink.add(r)
+
+def save_report(save_dir, tag, **extra):
+    '''Saves the run report of instrument.METRICS next to the results of the run'''
+    METRICS.save_report(f"{save_dir}/{tag} report {str(date.today())}.json", tag=tag, **extra)
+
+def load_market_caps(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def fetch_market_caps(companies, workers=8, cache_path=MARKET_CAPS, ttl=MARKET_CAP_TTL):
+    '''Sets market caps of given companies, fetching up to "workers" of them at once (requests are
+    rate limited by the scrapers). Caps younger than ttl seconds are taken from the cache file 
+    instead, except for handlers with caps_with_financials whose caps come with the loaded financials,
+    returns a dict of name: market cap for companies whose cap was set'''
+    cache = load_market_caps(cache_path) if cache_path else {}
+    now = time.time()
+    market_caps = {}
+    to_fetch = []
+    for c in companies:
+        entry = None if c.handler.caps_with_financials else cache.get(f"{c.handler.source}/{c.name}")
+        if entry and now - entry[1] < ttl:
+            c.market_cap = entry[0]
+            market_caps[c.name] = c.market_cap
+        else:
+            to_fetch.append(c)
+    METRICS.count("market caps cached", len(companies) - len(to_fetch))
+    METRICS.count("market caps fetched", len(to_fetch))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(c.set_market_cap): c for c in to_fetch}
+        for future in as_completed(futures):
+            c = futures[future]
+            try:
+                future.result()
+                market_caps[c.name] = c.market_cap
+                if c.market_cap:
+                    cache[f"{c.handler.source}/{c.name}"] = [c.market_cap, now]
+            except Exception as e:
+                METRICS.count("market cap errors")
+                log.warning("An error occurred while getting market cap of %s: %s", c.name, e)
+
+    if cache_path and to_fetch:
+        with open(cache_path, 'w') as file:
+            json.dump(cache, file)
+    return market_caps
+
+def load_sectors(companies, field=br.SECTOR):
+    '''Dict of name: sector (see BrHandler.get_sector) of companies with a known one'''
+    sectors = {}
+    for c in companies:
+        try:
+            sector = c.handler.get_sector(c.name, field)
         except Exception as e:
-            print(f"An error occurred while evaluating {c.name}: {e}")
+            log.warning("An error occurred while getting sector of %s: %s", c.name, e)
+            continue
+        if sector:
+            sectors[c.name] = sector
+    return sectors
 
-    csv_filename = f"{save_dir}/{tag} {str(date.today())}.csv"
-    with open(csv_filename, mode="w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=["Name", "Undervaluation Factor", "ROE", "Margin", "ROE Deviation", "Debt to Assets"])
-        writer.writeheader()
-        writer.writerows(results)
+def batch_eval_stocks(companies, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears,
+                      workers=8, market_cap_cache=MARKET_CAPS, peer_filters=(), peers=False, sector_field=br.SECTOR,
+                      discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02):
+    '''Vectorized eval_stocks - screens all companies at once with a Screener, then gets market caps
+    only for companies that passed the filters and values them, returns the Screener for re-screening.
+    peer_filters - filters relative to the sector of a company, see Screener.peer_screen, peers - adds
+    the sector and peer stats columns to the results. Peer stats of ROE, margin and debt to assets
+    compare a company with its whole sector, of the undervaluation factor with the companies of the 
+    sector that passed the filters (only they have market caps)'''
+    from screener import Screener, peer_fields, MIN_PEERS # NumPy is only loaded by the vectorized modes
+    screener = Screener(companies)
+    if peer_filters or peers:
+        screener.set_sectors(load_sectors(companies, sector_field))
+    passed = screener.screen(margin_filter, roe_filter, roe_deviation_filter, filter_backyears)
+    log.info("%d/%d companies passed the filters", passed.sum(), len(companies))
+    screener.set_market_caps(fetch_market_caps([companies[i] for i in passed.nonzero()[0]], workers, market_cap_cache))
+    params = (projection_length, growth_cap, terminal_growth)
+    if peer_filters:
+        passed &= screener.peer_screen(peer_filters, filter_backyears, discount_rate, MIN_PEERS, *params)
+        log.info("%d companies passed the peer filters", passed.sum())
+    stats = screener.peer_stats(filter_backyears, discount_rate, MIN_PEERS, *params) if peers else None
+    save_results(screener.results(passed, margin_filter, filter_backyears, discount_rate, peers=stats, projection_length=projection_length,
+                                  growth_cap=growth_cap, terminal_growth=terminal_growth),
+                 save_dir, tag, RESULT_FIELDS + peer_fields() if peers else RESULT_FIELDS)
+    return screener
 
-    print(f"Results saved to {csv_filename}")
+def eval_sensitivity(companies, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears,
+                     discount_rates=(0.055, 0.06, 0.065, 0.07, 0.075), growth_caps=(0.06, 0.08, 0.1, 0.12, 0.14),
+                     terminal_growths=(0.02,), projection_lengths=(5,), workers=8, market_cap_cache=MARKET_CAPS):
+    '''Evaluates the undervaluation factor of companies passing the filters over a grid of valuation
+    parameters in one pass, saves the grid and per-company robustness stats, see Screener.uvf_grid'''
+    from screener import Screener, save_sensitivity
+    screener = Screener(companies)
+    passed = screener.screen(margin_filter, roe_filter, roe_deviation_filter, filter_backyears)
+    screener.set_market_caps(fetch_market_caps([companies[i] for i in passed.nonzero()[0]], workers, market_cap_cache))
+    grid = screener.uvf_grid(discount_rates, growth_caps, terminal_growths, projection_lengths)
+    axes = {"discount_rate": discount_rates, "growth_cap": growth_caps,
+            "terminal_growth": terminal_growths, "projection_length": projection_lengths}
+    save_sensitivity(f"{save_dir}/{tag} sensitivity {str(date.today())}", screener.names, grid, axes, passed)
+    return grid
 
+def eval_monte_carlo(companies, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears,
+                     paths=10000, discount_rate=0.065, discount_deviation=0.01, projection_length=5, growth_cap=0.1,
+                     terminal_growth=0.02, seed=None, workers=8, market_cap_cache=MARKET_CAPS):
+    '''Monte Carlo valuation of companies passing the filters - intrinsic value percentiles and the
+    probability of undervaluation under uncertain ROE, payout ratio and discount rate, see Screener.monte_carlo'''
+    from screener import Screener, save_monte_carlo
+    screener = Screener(companies)
+    passed = screener.screen(margin_filter, roe_filter, roe_deviation_filter, filter_backyears)
+    screener.set_market_caps(fetch_market_caps([companies[i] for i in passed.nonzero()[0]], workers, market_cap_cache))
+    with METRICS.timer("monte carlo"):
+        result = screener.monte_carlo(filter_backyears, paths, discount_rate, discount_deviation, projection_length,
+                                      growth_cap, terminal_growth, seed=seed)
+    save_monte_carlo(f"{save_dir}/{tag} monte carlo {str(date.today())}", screener.names, result, passed)
+    return result
     
-def eval_br():
-    companies = prep_companies(BrHandler("data/gpw"), br.default_tickers(), BLACKLIST)
-    eval_stocks(companies,"analyses", "gpw", 0.05, 0.08, 0.5, 5, 1, BLACKLIST)
+def eval_shard(handler, tickers, margin_filter, roe_filter, roe_deviation_filter, filter_backyears,
+               discount_rate, projection_length, growth_cap, terminal_growth):
+    '''Worker of parallel_eval_stocks, loads, filters and values a shard of tickers without market caps, 
+    returns records of companies that passed - result row with the intrinsic value in place of 
+    the undervaluation factor, and the market cap if the handler has it without scraping, together
+    with a snapshot of the worker's METRICS'''
+    METRICS.reset()
+    records = []
+    for c in Universe(handler, tickers, use_black_list=False, cache_size=1):
+        try:
+            if not passes_filters(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+                continue
+            with METRICS.timer("valuation"):
+                iv = c.intrinsic_value(discount_rate, 5, projection_length, growth_cap, terminal_growth)
+                roe, margin, deviation = result_metrics(c, filter_backyears if margin_filter else 0)
+            METRICS.count("valued")
+            record = {
+                "Name": c.name,
+                "Intrinsic Value": iv,
+                "ROE": roe,
+                "Margin": margin,
+                "ROE Deviation": deviation,
+                "Debt to Assets": c.calc_debt_to_assets_current(),
+                "Market Cap": None
+            }
+            if handler.caps_with_financials:
+                c.set_market_cap()
+                record["Market Cap"] = c.market_cap
+            records.append(record)
+        except Exception as e:
+            METRICS.count("errors")
+            log.warning("An error occurred while evaluating %s: %s", c.name, e)
+    return records, METRICS.snapshot()
+
+def parallel_eval_stocks(handler, tickers, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears, 
+                         use_black_list, blacklist_dir, discount_rate=0.065, projection_length=5, growth_cap=0.1, 
+                         terminal_growth=0.02, processes=None, workers=8, market_cap_cache=MARKET_CAPS):
+    '''eval_stocks over a pool of processes - the ticker list is split into contiguous shards, each worker 
+    loads its own financials through the handler (see eval_shard), market caps of companies that passed
+    are fetched in this process and results are saved in ticker order, same as eval_stocks'''
+    from concurrent.futures import ProcessPoolExecutor # multiprocessing is slow to import
+    blacklist = load_blacklist(blacklist_dir) if use_black_list else []
+    tickers = [t for t in tickers if t not in blacklist]
+    processes = processes or os.cpu_count()
+    size = max(1, -(-len(tickers) // (processes * 4)))
+    shards = [tickers[i:i + size] for i in range(0, len(tickers), size)]
+    n = len(shards)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        shard_records = executor.map(eval_shard, [handler] * n, shards, [margin_filter] * n, [roe_filter] * n,
+                                     [roe_deviation_filter] * n, [filter_backyears] * n, [discount_rate] * n,
+                                     [projection_length] * n, [growth_cap] * n, [terminal_growth] * n)
+        records = []
+        for shard, snapshot in shard_records:
+            records += shard
+            METRICS.merge(snapshot)
+
+    missing = [Company(r["Name"], handler) for r in records if r["Market Cap"] is None]
+    market_caps = fetch_market_caps(missing, workers, market_cap_cache)
+    results = []
+    for r in records:
+        cap = r["Market Cap"] if r["Market Cap"] is not None else market_caps.get(r["Name"])
+        if not cap:
+            METRICS.count("errors")
+            log.warning("An error occurred while evaluating %s: missing market cap", r["Name"])
+            continue
+        results.append({
+            "Name": r["Name"],
+            "Undervaluation Factor": r["Intrinsic Value"] / cap,
+            "ROE": r["ROE"],
+            "Margin": r["Margin"],
+            "ROE Deviation": r["ROE Deviation"],
+            "Debt to Assets": r["Debt to Assets"]
+        })
+    save_results(results, save_dir, tag)
 
-def eval_gf():
-    companies = prep_companies(GfHandler("data/gf"), load_gf_tickers(), GPW_BLACKLIST)
-    eval_stocks(companies, "analyses", "gf", 0.05, 0.08, 0.8, 5, 1, GPW_BLACKLIST)
+def source_handler(source, data_dir=None, store=None):
+    '''Handler of a source - "gpw" for biznesradar, "gf" for Google Finance, reading data/{source}
+    unless data_dir is given'''
+    handler = BrHandler if source == "gpw" else GfHandler
+    return handler(data_dir or f"data/{source}", store)
 
+def source_tickers(source):
+    return br.default_tickers() if source == "gpw" else load_gf_tickers()
 
-BRH = BrHandler("data/gpw")
-GFH = GfHandler("data/gf")
+def evaluate(source, filters=None, discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02,
+             store=None, processes=1, incremental=False, tickers=None, data_dir=None, save_dir="analyses",
+             blacklist_dir=BLACKLIST, workers=8, market_cap_cache=MARKET_CAPS, peer_filters=(), peers=False, 
+             sector_field=br.SECTOR):
+    '''Evaluates companies of a source, filters - margin, ROE, ROE deviation and years back, by default
+    FILTERS of the source, store - optional FinStore to read financials from instead of data/{source}, 
+    processes - number of worker processes, more than 1 runs parallel_eval_stocks, incremental - 
+    values only companies with changed financials and keeps snapshots in the store (by default
+    data/financials.db), see incremental_eval_stocks, peer_filters and peers - filters and columns
+    relative to the sector of a company, run by batch_eval_stocks. The run report is saved next to 
+    the results, see save_report'''
+    METRICS.reset()
+    filters = filters or FILTERS[source]
+    params = (discount_rate, projection_length, growth_cap, terminal_growth)
+    handler = source_handler(source, data_dir, store)
+    tickers = tickers or source_tickers(source)
+    use_black_list = blacklist_dir is not None
+    if incremental:
+        companies = Universe(handler, tickers, blacklist_dir, use_black_list)
+        incremental_eval_stocks(companies, store or FinStore(STORE), save_dir, source, *filters, *params, workers, market_cap_cache)
+    elif peer_filters or peers:
+        companies = prep_companies(handler, tickers, blacklist_dir, use_black_list)
+        batch_eval_stocks(companies, save_dir, source, *filters, workers, market_cap_cache, peer_filters, peers, 
+                          sector_field, *params)
+    elif processes > 1:
+        parallel_eval_stocks(handler, tickers, save_dir, source, *filters, use_black_list, blacklist_dir, *params, 
+                             processes=processes, workers=workers, market_cap_cache=market_cap_cache)
+    else:
+        companies = Universe(handler, tickers, blacklist_dir, use_black_list)
+        eval_stocks(companies, save_dir, source, *filters, use_black_list, blacklist_dir, *params, workers, market_cap_cache)
+    save_report(save_dir, source, processes=processes, incremental=incremental)
 
+def eval_br(store=None, processes=1, incremental=False):
+    '''Evaluates GPW companies, see evaluate'''
+    evaluate("gpw", store=store, processes=processes, incremental=incremental)
+
+def eval_gf(store=None, processes=1, incremental=False):
+    '''Evaluates Google Finance companies, see evaluate'''
+    evaluate("gf", store=store, processes=processes, incremental=incremental)
+
+def fetch(source, tickers=None, data_dir=None, workers=None, retries=3, journal=None, quarantine=None, incremental=False):
+    '''Downloads financials of a source with the bulk_download of its scraper, returns its summary'''
+    data_dir = data_dir or f"data/{source}"
+    if source == "gpw":
+        return br.bulk_download(data_dir, tickers or br.default_tickers(), with_info = 1, workers = workers or 8, 
+                                incremental = incremental, retries = retries, journal = journal, quarantine = quarantine)
+    return gf.bulk_download(tickers or gf.default_tickers(), workers or 1, data_dir, retries = retries, 
+                            journal = journal, quarantine = quarantine)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="bizsval", description="Screens and values stocks from saved "
+                                     "biznesradar (gpw) or Google Finance (gf) financials")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="show progress, -vv for per company details")
+    source = argparse.ArgumentParser(add_help=False)
+    source.add_argument("source", choices=sorted(FILTERS))
+    source.add_argument("tickers", nargs="*", help="by default all tickers of the source")
+    source.add_argument("--data-dir", help="directory of the JSON files, data/{source} by default")
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("--store", nargs="?", const=STORE, help=f"read financials from a FinStore, {STORE} by default")
+    filters.add_argument("--margin", type=float, help="minimum net margin, 0 turns the filter off")
+    filters.add_argument("--roe", type=float, help="minimum mean ROE, 0 turns the filter off")
+    filters.add_argument("--roe-deviation", type=float, help="maximum ROE deviation, 0 turns the filter off")
+    filters.add_argument("--years", type=int, help="years back the filters look at")
+    filters.add_argument("--no-blacklist", action="store_true", help=f"do not skip tickers on {BLACKLIST}")
+    valuation = argparse.ArgumentParser(add_help=False)
+    valuation.add_argument("--discount-rate", type=float, default=0.065)
+    valuation.add_argument("--projection-length", type=int, default=5)
+    valuation.add_argument("--growth-cap", type=float, default=0.1)
+    valuation.add_argument("--terminal-growth", type=float, default=0.02)
+    valuation.add_argument("--market-caps", default=MARKET_CAPS, help="market cap cache file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fetch = commands.add_parser("fetch", parents=[source], help="download financials")
+    fetch.add_argument("--workers", type=int, help="download threads (gpw) or browsers (gf)")
+    fetch.add_argument("--retries", type=int, default=3)
+    fetch.add_argument("--journal", help="checkpoint journal to resume an interrupted run from")
+    fetch.add_argument("--quarantine", help="blacklist file for tickers that keep failing")
+    fetch.add_argument("--incremental", action="store_true", help="only refresh stale or changed statements (gpw)")
+
+    peer = argparse.ArgumentParser(add_help=False)
+    peer.add_argument("--peer", type=parse_peer_filter, action="append", default=[], metavar="FILTER",
+                      help="filter relative to the sector - {metric}_{stat}_{min|max}={value}, metric roe, margin, "
+                      "debt_to_assets or uvf (value only), stat median, percentile or z, e.g. roe_percentile_min=75, "
+                      "can be repeated")
+    peer.add_argument("--peers", action="store_true", help="add the sector and peer stats columns")
+    peer.add_argument("--industry", action="store_true", help="group by industry instead of sector")
+
+    screen = commands.add_parser("screen", parents=[source, filters, peer], help="list companies passing the filters, offline")
+    screen.add_argument("--out", help="CSV file to write, standard output by default")
+
+    value = commands.add_parser("value", parents=[source, filters, valuation, peer], help="value companies passing the filters")
+    value.add_argument("--processes", type=int, default=1)
+    value.add_argument("--incremental", action="store_true", help="only value companies whose financials changed")
+    value.add_argument("--stream", action="store_true", help="download, parse and value in one pipelined pass (gpw), "
+                       "see pipeline")
+    value.add_argument("--workers", type=int, default=8, help="market cap threads, download threads with --stream")
+    value.add_argument("--save-dir", default="analyses")
+
+    serve = commands.add_parser("serve", parents=[source, valuation], help="keep metrics in memory and answer "
+                                "queries over HTTP, see screen_server")
+    serve.add_argument("--years", type=int, default=5, help="years back the metrics look at")
+    serve.add_argument("--no-blacklist", action="store_true", help=f"do not skip tickers on {BLACKLIST}")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--poll", type=float, default=2, help="seconds between checks of the data files for changes")
+    return parser.parse_args(argv)
+
+def cli_filters(args):
+    '''Filters given on the command line, the rest from FILTERS of the source'''
+    given = (args.margin, args.roe, args.roe_deviation, args.years)
+    return tuple(d if g is None else g for g, d in zip(given, FILTERS[args.source]))
+
+def main(argv=None):
+    '''Command line entry point, python bizsval.py {fetch,screen,value,serve} SOURCE [TICKERS] [options]'''
+    args = parse_args(argv)
+    if args.verbose:
+        verbose(logging.DEBUG if args.verbose > 1 else logging.INFO, sys.stderr)
+    if args.command == "fetch":
+        summary = fetch(args.source, args.tickers, args.data_dir, args.workers, args.retries, args.journal, 
+                        args.quarantine, args.incremental)
+        failed = [t for t, status in summary.items() if status != "ok"]
+        print(f"fetched {len(summary) - len(failed)}/{len(summary)} tickers", file=sys.stderr)
+        return 1 if failed else 0
+    if args.command == "serve":
+        import screen_server
+        index = screen_server.ScreenIndex(args.source, args.tickers, args.data_dir, None if args.no_blacklist else BLACKLIST, 
+                                          args.market_caps, args.years, args.discount_rate, args.projection_length, 
+                                          args.growth_cap, args.terminal_growth)
+        screen_server.serve(index, args.host, args.port, args.poll)
+        return 0
+
+    if args.command == "value" and args.stream and (args.source != "gpw" or args.store or args.incremental):
+        print("--stream only works for gpw, without --store and --incremental", file=sys.stderr)
+        return 2
+    if args.command == "value" and (args.peer or args.peers) and (args.stream or args.incremental or args.processes > 1):
+        print("--peer and --peers do not work with --stream, --incremental and --processes", file=sys.stderr)
+        return 2
+    if args.command == "screen" and any(f[0] == "uvf" for f in args.peer):
+        print("uvf peer filters need market caps, use value instead of screen", file=sys.stderr)
+        return 2
+    store = FinStore(args.store) if args.store else None
+    blacklist_dir = None if args.no_blacklist else BLACKLIST
+    sector_field = br.INDUSTRY if args.industry else br.SECTOR
+    if args.command == "screen":
+        handler = source_handler(args.source, args.data_dir, store)
+        tickers = args.tickers or source_tickers(args.source)
+        fields = SCREEN_FIELDS
+        if args.peer or args.peers:
+            from screener import peer_fields, OFFLINE_PEER_METRICS
+            fields = SCREEN_FIELDS + peer_fields(OFFLINE_PEER_METRICS)
+            companies = prep_companies(handler, tickers, blacklist_dir, not args.no_blacklist)
+            rows = peer_screen_stocks(companies, *cli_filters(args), args.peer, sector_field)
+        else:
+            rows = screen_stocks(Universe(handler, tickers, blacklist_dir, not args.no_blacklist), *cli_filters(args))
+        out = open(args.out, "w", newline="") if args.out else sys.stdout
+        try:
+            writer = csv.DictWriter(out, fieldnames=fields, lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rows)
+        finally:
+            if args.out:
+                out.close()
+    elif args.stream:
+        import pipeline
+        pipeline.stream_eval_br(args.tickers, args.save_dir, cli_filters(args), discount_rate=args.discount_rate,
+                                projection_length=args.projection_length, growth_cap=args.growth_cap, 
+                                terminal_growth=args.terminal_growth, data_dir=args.data_dir or "data/gpw", 
+                                blacklist_dir=blacklist_dir, fetch_workers=args.workers)
+    else:
+        evaluate(args.source, cli_filters(args), args.discount_rate, args.projection_length, args.growth_cap, 
+                 args.terminal_growth, store, args.processes, args.incremental, args.tickers or None, args.data_dir, 
+                 args.save_dir, blacklist_dir, args.workers, args.market_caps, args.peer, args.peers, sector_field)
+    return 0
 
+if __name__ == "__main__":
+    sys.exit(main())
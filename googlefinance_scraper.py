@@ -1,8 +1,111 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
+from lazy import lazy_import
+from contextlib import contextmanager
+from instrument import METRICS, log
+from journal import run_tickers, RETRIES
+import threading
+import atexit
+import queue
 import time
 import json
 
+webdriver = lazy_import("selenium.webdriver") # Selenium is loaded when a browser is first needed
+By = lazy_import("selenium.webdriver.common.by", "By")
+EC = lazy_import("selenium.webdriver.support.expected_conditions")
+ui = lazy_import("selenium.webdriver.support.ui")
+exceptions = lazy_import("selenium.common.exceptions")
+
+URL = "https://www.google.com/finance/quote/"
+WAIT = 10 # seconds to wait for page elements before giving up
+CHANGE_WAIT = 2 # seconds to wait for the report of a picked year to be shown
+POLL = 0.05
+READ_VALUES = "return Array.from(document.getElementsByClassName('QXDnM'), e => e.innerText.trim());"
+
+def new_driver(headless = True):
+    options = webdriver.EdgeOptions()
+    if headless:
+        options.add_argument("--headless=new")
+    return webdriver.Edge(options = options)
+
+def reject_cookies(driver):
+    list_ = driver.find_elements(By.CLASS_NAME, "VfPpkd-vQzf8d")
+    for element in list_:  # FINDING REJECT BTN
+        if element.text == "Odrzuć wszystko":
+            element.click()
+            break
+
+def is_alive(driver):
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+class DriverPool:
+    '''Up to "size" long-lived browsers reused across tickers, started on first use. A browser
+    rejects cookies on its first page and keeps that state, one that crashed is replaced
+    with a new one, all of them are quit on close() or at interpreter exit. The exit hook is only
+    registered while the pool has browsers, so a closed pool is not kept alive by it'''
+    def __init__(self, size = 1, headless = True):
+        self.size = size
+        self.headless = headless
+        self.idle = queue.Queue()
+        self.drivers = []
+        self.consented = set()
+        self.lock = threading.Lock()
+        self.registered = False
+        for i in range(size):
+            self.idle.put(None)
+
+    @contextmanager
+    def driver(self):
+        '''Borrows a browser for the duration of the with block'''
+        driver = self.idle.get()
+        try:
+            if driver is None:
+                driver = new_driver(self.headless)
+                with self.lock:
+                    self.drivers.append(driver)
+                    if not self.registered:
+                        atexit.register(self.close)
+                        self.registered = True
+            yield driver
+        except Exception:
+            if driver is not None and not is_alive(driver):
+                log.warning("browser crashed, it will be restarted")
+                METRICS.count("browser crashes")
+                self.discard(driver)
+                driver = None
+            raise
+        finally:
+            self.idle.put(driver)
+
+    def open(self, driver, url):
+        driver.get(url)
+        if id(driver) not in self.consented:
+            reject_cookies(driver)
+            self.consented.add(id(driver))
+
+    def discard(self, driver):
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+            self.consented.discard(id(driver))
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            drivers = list(self.drivers)
+            if self.registered:
+                atexit.unregister(self.close)
+                self.registered = False
+        for driver in drivers:
+            self.discard(driver)
+
+POOL = DriverPool()
+
 def remove_suffix(string):
     M = {"bln":10**9,
         "mld": 10**6,
@@ -27,62 +130,81 @@ def virtual_dividend(net_incomes, equity):
         x += 1
     return dividends
 
-def get_market_cap(company):
-    URL = "https://www.google.com/finance/quote/"
-    driver = webdriver.Edge()
-    driver.get(f"{URL}{company}")
-    list_ = driver.find_elements(By.CLASS_NAME, "VfPpkd-vQzf8d")
-
-    for element in list_:  # FINDING REJECT BTN
-        if element.text == "Odrzuć wszystko":
-            element.click()
-            break
-        
-    cap = driver.find_elements(By.CLASS_NAME, 'P6K39c')[3].text
+def get_market_cap(company, pool = None):
+    pool = pool or POOL
+    with pool.driver() as driver:
+        pool.open(driver, f"{URL}{company}")
+        cap = driver.find_elements(By.CLASS_NAME, 'P6K39c')[3].text
     cap = remove_suffix((cap[:len(cap)-4]))
      
     return cap
 
-def get_financials(company, save = True, dir_ = "data/gf"):       
-    URL = "https://www.google.com/finance/quote/"
-    driver = webdriver.Edge()
-    driver.get(f"{URL}{company}")
-    list_ = driver.find_elements(By.XPATH, '//*[@jsname="tWT92d"]')
-    list_[0].click()
-
-    annual_btn = driver.find_element(
-        By.XPATH, '//*[@id="annual2"]/span[2]')
-    annual_btn.click()
-    time.sleep(1)
-    x = driver.find_elements(By.CLASS_NAME, 'gjKCb')
-    x[1].click()
+def read_values(driver):
+    '''texts of all report values on the page, read in a single round trip to the browser'''
+    return driver.execute_script(READ_VALUES)
+
+def is_selected(driver, option):
+    found = driver.find_elements(By.ID, option)
+    return bool(found) and found[0].get_attribute("aria-selected") == "true"
+
+def year_shown(option, before):
+    '''wait condition - the year option is selected and the report was redrawn, i.e. its values are
+    no longer all the same as before (a single repeated figure does not hold it up)'''
+    def shown(driver):
+        if not is_selected(driver, option):
+            return False
+        now = read_values(driver)
+        return len(now) > 10 and now != before and now
+    return shown
+
+def scrape_financials(driver, timings = None):
+    '''scrapes the last five annual reports from an open quote page, waits for elements instead of 
+    sleeping, durations of the steps are added to the timings dict if one is given'''
+    timings = {} if timings is None else timings
+    wait = ui.WebDriverWait(driver, WAIT, poll_frequency = POLL)
+    last = time.perf_counter()
+    def lap(step):
+        nonlocal last
+        now = time.perf_counter()
+        timings[step] = timings.get(step, 0) + now - last
+        last = now
+
+    wait.until(EC.element_to_be_clickable((By.XPATH, '//*[@jsname="tWT92d"]'))).click()
+    lap("financials tab")
+    wait.until(EC.element_to_be_clickable((By.XPATH, '//*[@id="annual2"]/span[2]'))).click()
+    lap("annual")
+    x = wait.until(lambda d: d.find_elements(By.CLASS_NAME, 'gjKCb')[1:])
+    x[0].click()
+    values = wait.until(lambda d: len(read_values(d)) > 10 and read_values(d))
+    lap("balance sheet")
     vals = {"revenue": [],
             "net_income": [],
             "equity": [],
             "assets":[],
             "liabilities":[],
             "market_cap": 0}
-    time.sleep(1)
     for i in range(5):
-        year = driver.find_elements(
-            By.XPATH, f'//*[@id="option-{i}"]/span')
-        for x in year[:2]:
-            x.click()
-        list_ = driver.find_elements(By.CLASS_NAME, "QXDnM")
-        temp = []
-        for element in list_:
+        if not is_selected(driver, f"option-{i}"):
+            year = driver.find_elements(
+                By.XPATH, f'//*[@id="option-{i}"]/span')
+            for x in year[:2]:
+                x.click()
             try:
-                temp.append(element.text)
-            except:
-                pass
-        print(temp)
+                values = ui.WebDriverWait(driver, CHANGE_WAIT, poll_frequency = POLL).until(year_shown(f"option-{i}", values))
+            except exceptions.TimeoutException:
+                # saving what is on the page could store the previous year's figures, retried by bulk_download
+                METRICS.count("gf year timeouts")
+                raise exceptions.TimeoutException(f"report of option-{i} not shown within {CHANGE_WAIT}s")
+        temp = values
+        log.debug("%s", temp)
         vals["revenue"].append(remove_suffix((temp[0])))
         vals["net_income"].append(remove_suffix((temp[2])))
         vals["equity"].append(remove_suffix((temp[10])))
         vals["assets"].append(remove_suffix((temp[8])))
         vals["liabilities"].append(remove_suffix((temp[9])))
+        lap(f"year {i}")
     
-    list0 = driver.find_elements(By.CLASS_NAME, 'P6K39c')
+    list0 = wait.until(lambda d: d.find_elements(By.CLASS_NAME, 'P6K39c')[5:] and d.find_elements(By.CLASS_NAME, 'P6K39c'))
     c = list0[3].text
     c = remove_suffix((c[:len(c)-4]))
   
@@ -93,8 +215,22 @@ def get_financials(company, save = True, dir_ = "data/gf"):
             vals["pe"] = "NaN"
     vals["market_cap"] = c
     vals["dividend"] = virtual_dividend(vals['net_income'], vals['equity'])
+    lap("market cap")
+    return vals
+
+def get_financials(company, save = True, dir_ = "data/gf", pool = None, timings = None):       
+    pool = pool or POOL
+    timings = {} if timings is None else timings
+    with pool.driver() as driver:
+        start = time.perf_counter()
+        pool.open(driver, f"{URL}{company}")
+        timings["page load"] = time.perf_counter() - start
+        vals = scrape_financials(driver, timings)
+    for step, seconds in timings.items():
+        METRICS.observe(f"gf {step}", seconds)
+    METRICS.observe("gf scrape", sum(timings.values()))
+    log.info("%s scraped in %.2fs: %s", company, sum(timings.values()), ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
 
-    
     if save:
         c = company.replace(':','-')
         with open(f"{dir_}/{c}.json", 'w') as file:
@@ -111,23 +247,32 @@ def default_tickers():
        
     return ticks
 
-def bulk_download(tickers):
-    for t in tickers:
-        try:
-            get_financials(t, dir_ = "data/gf")
-        except:
-            pass
-    
-def test_financials(company, save = True, dir_ = "data/gf"):       
-    URL = "https://www.google.com/finance/quote/"
-    driver = webdriver.Edge()
-    driver.get(f"{URL}{company}")
+def transient(e):
+    '''timeouts and browser errors are worth retrying, a crashed browser is replaced by the pool'''
+    return isinstance(e, exceptions.WebDriverException)
 
-    list_ = driver.find_elements(By.XPATH, '//*[@jsname="tWT92d"]')
-    list_[0].click()
+def bulk_download(tickers, workers = 1, dir_ = "data/gf", headless = True, retries = RETRIES, journal = None, quarantine = None):
+    '''downloads financials of many tickers, sharded across a pool of "workers" browsers,
+    returns a dict with "ok" or the error message for every ticker. Tickers failing on transient
+    errors are retried up to "retries" times, with a journal path the job can be resumed after
+    an interruption and tickers failing again and again are added to the quarantine blacklist,
+    see journal.run_tickers'''
+    pool = DriverPool(workers, headless)
+    try:
+        summary, results = run_tickers(lambda t: get_financials(t, dir_ = dir_, pool = pool), tickers, workers,
+                                       transient, retries, journal = journal, quarantine = quarantine)
+    finally:
+        pool.close()
+
+    failed = [t for t, status in summary.items() if status != "ok"]
+    log.info("saved %d/%d tickers, failed: %s", len(summary) - len(failed), len(summary), failed)
+    return summary
     
-    return list_
-        
-     
-                
+def test_financials(company, save = True, dir_ = "data/gf", pool = None):       
+    pool = pool or POOL
+    with pool.driver() as driver:
+        pool.open(driver, f"{URL}{company}")
+        list_ = driver.find_elements(By.XPATH, '//*[@jsname="tWT92d"]')
+        list_[0].click()
     
+    return list_
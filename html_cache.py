@@ -0,0 +1,107 @@
+import threading
+import hashlib
+import gzip
+import zlib
+import json
+import os
+from datetime import date
+from glob import glob
+
+HTML_CACHE = "data/html"
+MAX_BYTES = 2 * 1024 ** 3
+
+class ResponseCache:
+    '''On-disk cache of raw pages, gzipped, one file per URL and fetch date - {hash}-{date}.html.gz, 
+    with an index of hash: URL appended to as new URLs come in (index.jsonl). Pages are written to
+    a temporary file first, unreadable pages and index lines (e.g. cut off by a crash) are treated
+    as not cached. When the files take more than max_bytes the least recently used ones are removed'''
+    def __init__(self, dir_=HTML_CACHE, max_bytes=MAX_BYTES):
+        self.dir = dir_
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(dir_, exist_ok=True)
+        self.index = {}
+        try:
+            with open(f"{dir_}/index.jsonl") as file:
+                for line in file:
+                    try:
+                        key, url = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.index[key] = url
+        except FileNotFoundError:
+            pass
+        self.size = sum(os.path.getsize(p) for p in glob(f"{dir_}/*.html.gz"))
+
+    def key(self, url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def path(self, url, day):
+        return f"{self.dir}/{self.key(url)}-{day}.html.gz"
+
+    def put(self, url, content, day=None):
+        path = self.path(url, day or str(date.today()))
+        data = gzip.compress(content)
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp, 'wb') as file:
+            file.write(data)
+        with self.lock:
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp, path)
+            self.size += len(data) - old
+            if self.index.get(self.key(url)) != url:
+                self.index[self.key(url)] = url
+                with open(f"{self.dir}/index.jsonl", 'a') as file:
+                    file.write(json.dumps([self.key(url), url]) + "\n")
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        paths = sorted(glob(f"{self.dir}/*.html.gz"), key=os.path.getmtime)
+        for path in paths:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    def dates(self, url):
+        prefix = len(self.key(url)) + 1
+        return sorted(os.path.basename(p)[prefix:-len(".html.gz")] for p in glob(f"{self.dir}/{self.key(url)}-*.html.gz"))
+
+    def get(self, url, day=None):
+        '''Returns the page fetched on a given day, by default the latest one, or None'''
+        if day is None:
+            dates = self.dates(url)
+            if not dates:
+                return None
+            day = dates[-1]
+        path = self.path(url, day)
+        try:
+            with open(path, 'rb') as file:
+                content = gzip.decompress(file.read())
+        except (OSError, EOFError, zlib.error): # missing, or cut off by a crash
+            return None
+        os.utime(path)
+        return content
+
+    def entries(self):
+        '''(url, date) of every cached page'''
+        for path in sorted(glob(f"{self.dir}/*.html.gz")):
+            key, day = os.path.basename(path)[:-len(".html.gz")].split("-", 1)
+            if key in self.index:
+                yield self.index[key], day
+
+class CachedResponse:
+    '''Stands in for a requests.Response in replay mode'''
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+        self.status_code = 200
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def raise_for_status(self):
+        pass
@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+import json
+import math
+import sys
+from contextlib import contextmanager
+
+log = logging.getLogger("bizval") # progress is logged at INFO, per company details at DEBUG
+
+def verbose(level=logging.INFO, stream=None):
+    '''Prints messages of the "bizval" logger from level up, by default only warnings are shown'''
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.handlers = [handler]
+    log.setLevel(level)
+
+class Histogram:
+    '''Count, sum, min and max of observed values with counts in power of two buckets,
+    a bucket holds values up to its bound'''
+    __slots__ = ("count", "sum", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        bound = 2.0 ** math.frexp(value)[1] if value > 0 else 0
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def merge(self, state):
+        self.count += state["count"]
+        self.sum += state["sum"]
+        self.min = min(self.min, state["min"])
+        self.max = max(self.max, state["max"])
+        for bound, n in state["buckets"].items():
+            self.buckets[float(bound)] = self.buckets.get(float(bound), 0) + n
+
+    def state(self):
+        return {"count": self.count, "sum": self.sum, "min": self.min, "max": self.max,
+                "mean": self.sum / self.count, "buckets": dict(sorted(self.buckets.items()))}
+
+class Metrics:
+    '''Thread safe counters and histograms of a run, timers are histograms of seconds'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(value)
+
+    @contextmanager
+    def timer(self, name):
+        '''Times the block into histogram "name", also when it raises'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {name: h.state() for name, h in self.histograms.items()}}
+
+    def merge(self, snapshot):
+        '''Adds a snapshot of other Metrics, e.g. of a worker process'''
+        with self.lock:
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, state in snapshot["histograms"].items():
+                self.histograms.setdefault(name, Histogram()).merge(state)
+
+    def report(self, **extra):
+        '''Run report - start time, duration, counters, histograms and any extra fields'''
+        report = {"started": self.started, "seconds": time.time() - self.started}
+        report.update(extra)
+        report.update(self.snapshot())
+        return report
+
+    def save_report(self, path, **extra):
+        with open(path, 'w') as file:
+            json.dump(self.report(**extra), file, indent=1)
+        log.info("Run report saved to %s", path)
+
+METRICS = Metrics()
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from instrument import METRICS, log
+import threading
+import random
+import json
+import time
+import os
+
+BLACKLIST = "data/blacklist.json"
+RETRIES = 3 # retries of a ticker after a transient failure
+BACKOFF = 2 # seconds before the first retry, doubled for every next one
+QUARANTINE_AFTER = 2 # failed runs after which a ticker is quarantined
+_blacklist_lock = threading.Lock()
+
+def load_blacklist(dir_):
+    with open(dir_, 'r') as blacklist:
+        return json.load(blacklist)
+
+def add_to_blacklist(company, dir_):
+    with _blacklist_lock:
+        _list = load_blacklist(dir_)
+        with open(dir_, 'w') as blacklist:
+            if company not in _list:
+                _list.append(company)
+            json.dump(_list, blacklist)
+
+class Journal:
+    '''Checkpoint journal of a bulk download, one JSON line per finished ticker - its status ("ok",
+    "failed" or "quarantined"), attempts and error, written as soon as the ticker is done. Tickers
+    that are ok or quarantined are skipped when an interrupted job is resumed from the same journal.
+    finish() ends the job - tickers that failed in it get one more failed run in the failures file
+    ({journal}-failures.json, kept for quarantine) and the journal is emptied, so the next job
+    starts over'''
+    def __init__(self, path):
+        self.path = path
+        self.failures_path = f"{os.path.splitext(path)[0]}-failures.json"
+        self.lock = threading.Lock()
+        self.status = {}
+        try:
+            with open(self.failures_path) as file:
+                self.failures = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.failures = {}
+        try:
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # last line cut off by a crash
+                        continue
+                    self.status[entry["ticker"]] = entry["status"]
+        except FileNotFoundError:
+            pass
+        self.file = open(path, 'a')
+
+    def done(self, ticker):
+        return self.status.get(ticker) in ("ok", "quarantined")
+
+    def failed_runs(self, ticker):
+        '''Failed runs of a ticker, counting this job if it failed in it'''
+        return self.failures.get(ticker, 0) + (self.status.get(ticker) in ("failed", "quarantined"))
+
+    def record(self, ticker, status, **fields):
+        with self.lock:
+            self.status[ticker] = status
+            self.file.write(json.dumps(dict(ticker=ticker, status=status, time=time.time(), **fields)) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def finish(self):
+        '''Ends the job, see Journal'''
+        with self.lock:
+            for ticker in self.status:
+                self.failures[ticker] = self.failed_runs(ticker)
+            self.failures = {t: n for t, n in self.failures.items() if n}
+            temp = f"{self.failures_path}.tmp"
+            with open(temp, 'w') as file:
+                json.dump(self.failures, file, indent=1, sort_keys=True)
+            os.replace(temp, self.failures_path)
+            self.file.truncate(0)
+            self.status = {}
+
+    def close(self):
+        self.file.close()
+
+def backoff_delay(attempt, backoff=BACKOFF):
+    '''Jittered exponential backoff - backoff * 2 ** attempt seconds, +-50%'''
+    return backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+def with_retries(work, ticker, transient, retries=RETRIES, backoff=BACKOFF):
+    '''Calls work(ticker), retrying it after exceptions for which transient(exception) is true,
+    returns the result and the number of attempts'''
+    for attempt in range(retries + 1):
+        try:
+            return work(ticker), attempt + 1
+        except Exception as e:
+            if attempt == retries or not transient(e):
+                e.attempts = attempt + 1
+                raise
+            delay = backoff_delay(attempt, backoff)
+            METRICS.count("retries")
+            log.info("retrying %s in %.1fs after %s: %s", ticker, delay, e.__class__.__name__, e)
+            time.sleep(delay)
+
+def run_tickers(work, tickers, workers=1, transient=lambda e: True, retries=RETRIES, backoff=BACKOFF,
+                journal=None, quarantine=None, quarantine_after=QUARANTINE_AFTER):
+    '''Runs work(ticker) for every ticker on a pool of "workers" threads with retries of transient
+    failures, see with_retries. With a journal path finished tickers are recorded in a Journal and
+    skipped if it already has them, the journal is finished once every ticker was run so the next
+    call starts over. Tickers on the quarantine list (a blacklist file) are skipped, with a journal
+    those that failed in quarantine_after runs are added to it.
+    Returns a dict of ticker: "ok" or the error message, and a dict of ticker: result of work'''
+    journal = Journal(journal) if journal else None
+    skip = set(load_blacklist(quarantine)) if quarantine else set()
+    summary = {}
+    results = {}
+    todo = []
+    for t in tickers:
+        if t in skip:
+            summary[t] = "quarantined"
+        elif journal and journal.done(t):
+            summary[t] = journal.status[t]
+        else:
+            todo.append(t)
+    if len(todo) < len(tickers):
+        log.info("skipping %d finished or quarantined tickers", len(tickers) - len(todo))
+
+    executor = ThreadPoolExecutor(max_workers = workers)
+    try:
+        futures = {executor.submit(with_retries, work, t, transient, retries, backoff): t for t in todo}
+        for future in as_completed(futures):
+            t = futures[future]
+            try:
+                results[t], attempts = future.result()
+                summary[t] = "ok"
+                if journal:
+                    journal.record(t, "ok", attempts=attempts)
+            except Exception as e:
+                summary[t] = f"{e.__class__.__name__}: {e}"
+                METRICS.count("failed tickers")
+                log.warning("failed to download %s: %s", t, summary[t])
+                if journal:
+                    journal.record(t, "failed", attempts=getattr(e, "attempts", 1), error=summary[t])
+                    if quarantine and journal.failed_runs(t) >= quarantine_after:
+                        add_to_blacklist(t, quarantine)
+                        journal.record(t, "quarantined")
+                        METRICS.count("quarantined")
+                        log.warning("%s quarantined after %d failed runs", t, journal.failed_runs(t))
+        if journal:
+            journal.finish()
+    finally:
+        executor.shutdown(cancel_futures = True) # e.g. on KeyboardInterrupt, the journal lets the job resume
+        if journal:
+            journal.close()
+    return {t: summary[t] for t in tickers}, results
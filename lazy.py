@@ -0,0 +1,28 @@
+import importlib
+import threading
+
+class LazyImport:
+    '''Stands in for a module, or an attribute of one, that is imported on first attribute access,
+    so that importing a module does not pay for dependencies of code paths it never runs'''
+    def __init__(self, module, attr=None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._target is None:
+                target = importlib.import_module(self._module)
+                self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._target or self._load(), name)
+
+    def __repr__(self):
+        return f"<lazy {self._module}{'.' + self._attr if self._attr else ''}>"
+
+def lazy_import(module, attr=None):
+    '''Module (or its attribute) imported when first used, e.g. webdriver = lazy_import("selenium.webdriver")'''
+    return LazyImport(module, attr)
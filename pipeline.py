@@ -0,0 +1,170 @@
+from bizsval import (BrHandler, Company, acint, screen_company, value_company, result_path, save_report, load_blacklist,
+                     RESULT_FIELDS, BLACKLIST, FILTERS)
+import biznesradar_scraper as br
+from journal import with_retries, RETRIES, BACKOFF
+from result_sink import ResultSink
+from instrument import METRICS, log
+import threading
+import queue
+import json
+import time
+
+STATEMENTS = (br.INCOME, br.BALANCE, br.CASH) # the balance sheet page also carries the info box with the market cap
+QUEUE_SIZE = 32 # tickers waiting between two stages
+DONE = None # end of stream marker
+
+def put(queue_, item, stop):
+    '''Puts to a bounded queue, gives up when the pipeline is stopped'''
+    while not stop.is_set():
+        try:
+            queue_.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def fetch_pages(ticker):
+    '''Report pages of a ticker, one per statement of STATEMENTS'''
+    pages = {}
+    for statement in STATEMENTS:
+        response = br.fetch(br.statement_url(ticker, statement))
+        response.raise_for_status()
+        pages[statement] = response.content
+    return pages
+
+def parse_pages(handler, ticker, pages, save_dir=None):
+    '''Company with financials and market cap from the report pages of a ticker, the statements
+    and info are saved to save_dir in the layout of biznesradar_scraper.download_ticker'''
+    raw = {}
+    info = {}
+    for statement, page in pages.items():
+        data, inf = br.parse_report(page, with_info = statement == br.BALANCE)
+        raw.update(data)
+        info.update(inf)
+        if save_dir:
+            with open(f"{save_dir}/{ticker}-{statement}.json", 'w') as f:
+                json.dump(data, f)
+    if save_dir and info:
+        with open(f"{save_dir}/{ticker}-info.json", 'w') as f:
+            json.dump(info, f)
+    c = Company(ticker, handler)
+    c.financials = handler.refine_financials(raw)
+    if "Kapitalizacja:" in info:
+        c.market_cap = acint(info["Kapitalizacja:"])/1000
+    return c
+
+def fetcher(tickers, pages, stop, retries, backoff):
+    '''Fetch stage, takes tickers until the queue is empty'''
+    while not stop.is_set():
+        try:
+            ticker = tickers.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            with METRICS.timer("fetch stage"):
+                result, _ = with_retries(fetch_pages, ticker, br.transient, retries, backoff)
+        except Exception as e:
+            METRICS.count("fetch errors")
+            log.warning("failed to download %s: %s: %s", ticker, e.__class__.__name__, e)
+            continue
+        if not put(pages, (ticker, result), stop):
+            return
+
+def parser(handler, pages, companies, stop, save_dir):
+    '''Parse stage, runs until it gets the end of stream marker'''
+    while not stop.is_set():
+        try:
+            item = pages.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is DONE:
+            break
+        ticker, result = item
+        try:
+            with METRICS.timer("parse stage"):
+                c = parse_pages(handler, ticker, result, save_dir)
+        except Exception as e:
+            METRICS.count("load errors")
+            log.warning("An error occurred while initializing company: %s : %s", ticker, e)
+            continue
+        if not put(companies, c, stop):
+            return
+    put(companies, DONE, stop)
+
+def stream_eval_stocks(tickers, save_dir, tag, margin_filter, roe_filter, roe_deviation_filter, filter_backyears,
+                       discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02, data_dir="data/gpw",
+                       blacklist_dir=BLACKLIST, fetch_workers=8, parse_workers=2, queue_size=QUEUE_SIZE, rate=br.RATE,
+                       retries=RETRIES, backoff=BACKOFF, batch_size=1, parquet=False):
+    '''Scrapes, parses, filters and values biznesradar tickers in one pass - fetch_workers threads
+    download the report pages of a ticker, parse_workers threads parse them (saving the statements
+    to data_dir, None to keep them in memory only) and this thread filters and values every company
+    as soon as it is parsed, writing the result right away (see ResultSink). Stages are connected
+    by bounded queues of queue_size tickers, so a slow stage holds back the ones before it instead
+    of piling up pages. Filters and results are the same as eval_stocks, market caps come from the
+    info box of the balance sheet page, rows are written in the order companies are parsed. Returns
+    the number of results'''
+    br.set_rate("www.biznesradar.pl", rate)
+    blacklist = load_blacklist(blacklist_dir) if blacklist_dir else []
+    todo = queue.Queue()
+    for t in tickers:
+        if t in blacklist:
+            METRICS.count("blacklisted")
+        else:
+            todo.put(t)
+    pages = queue.Queue(queue_size)
+    companies = queue.Queue(queue_size)
+    stop = threading.Event()
+    handler = BrHandler(data_dir or "data/gpw")
+    fetchers = [threading.Thread(target=fetcher, args=(todo, pages, stop, retries, backoff), daemon=True)
+                for i in range(fetch_workers)]
+    parsers = [threading.Thread(target=parser, args=(handler, pages, companies, stop, data_dir), daemon=True)
+               for i in range(parse_workers)]
+    for thread in fetchers + parsers:
+        thread.start()
+
+    def close_pages():
+        for thread in fetchers:
+            thread.join()
+        for thread in parsers:
+            put(pages, DONE, stop)
+    threading.Thread(target=close_pages, daemon=True).start()
+
+    start = time.perf_counter()
+    running = parse_workers
+    results = 0
+    try:
+        with ResultSink(result_path(save_dir, tag), RESULT_FIELDS, batch_size, parquet) as sink:
+            while running:
+                c = companies.get()
+                if c is DONE:
+                    running -= 1
+                    continue
+                try:
+                    if screen_company(c, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+                        continue
+                    if not c.market_cap:
+                        METRICS.count("errors")
+                        log.warning("An error occurred while evaluating %s: missing market cap", c.name)
+                        continue
+                    row = value_company(c, discount_rate, projection_length, growth_cap, terminal_growth,
+                                        filter_backyears if margin_filter else 0)
+                except Exception as e:
+                    METRICS.count("errors")
+                    log.warning("An error occurred while evaluating %s: %s", c.name, e)
+                    continue
+                sink.add(row, c.financials)
+                results += 1
+                if results == 1:
+                    METRICS.observe("first result", time.perf_counter() - start)
+                log.info("%s undervaluation factor %.2f", c.name, row["Undervaluation Factor"])
+        return results
+    finally:
+        stop.set()
+
+def stream_eval_br(tickers=None, save_dir="analyses", filters=None, **kwargs):
+    '''stream_eval_stocks of GPW tickers (by default all of them) with the filters of eval_br, saves
+    the run report next to the results'''
+    METRICS.reset()
+    count = stream_eval_stocks(tickers or br.default_tickers(), save_dir, "gpw", *(filters or FILTERS["gpw"]), **kwargs)
+    save_report(save_dir, "gpw", streamed=True)
+    return count
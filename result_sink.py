@@ -0,0 +1,68 @@
+from instrument import log
+from lazy import lazy_import
+from importlib.util import find_spec
+import csv
+
+pa = lazy_import("pyarrow") # Parquet output is optional, pyarrow is loaded only when it is used
+pq = lazy_import("pyarrow.parquet")
+
+INPUT_FIELDS = ("equity", "net_income", "dividend", "revenue", "assets", "liabilities")
+
+class ResultSink:
+    '''Writes result rows to {path}.csv as they come, in batches of batch_size rows flushed to disk
+    so the file can be followed during a run and a crash loses at most one batch. With parquet set
+    the rows also go to {path}.parquet, one row group per batch, together with the yearly inputs
+    of the valuation (INPUT_FIELDS of the financials given with a row) as list columns. Parquet
+    needs pyarrow and the file is only readable once the sink is closed. Use as a context manager'''
+    def __init__(self, path, fields, batch_size=64, parquet=False):
+        if parquet and find_spec("pyarrow") is None:
+            raise ImportError("Parquet output requires pyarrow")
+        self.path = path
+        self.fields = fields
+        self.batch_size = batch_size
+        self.rows = []
+        self.inputs = []
+        self.count = 0
+        self.file = open(f"{path}.csv", mode="w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=fields)
+        self.writer.writeheader()
+        self.file.flush()
+        self.parquet = None
+        if parquet:
+            columns = [pa.field(f, pa.string() if f == "Name" else pa.float64()) for f in fields]
+            columns += [pa.field(f, pa.list_(pa.float64())) for f in INPUT_FIELDS]
+            self.schema = pa.schema(columns)
+            self.parquet = pq.ParquetWriter(f"{path}.parquet", self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, row, financials=None):
+        self.rows.append(row)
+        if self.parquet:
+            self.inputs.append({f: list(financials[f]) if financials else None for f in INPUT_FIELDS})
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        self.writer.writerows(self.rows)
+        self.file.flush()
+        if self.parquet:
+            columns = {f: [row[f] for row in self.rows] for f in self.fields}
+            columns.update({f: [inputs[f] for inputs in self.inputs] for f in INPUT_FIELDS})
+            self.parquet.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+        self.count += len(self.rows)
+        self.rows = []
+        self.inputs = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.parquet:
+            self.parquet.close()
+        log.info("Results saved to %s.csv%s", self.path, " and .parquet" if self.parquet else "")
@@ -0,0 +1,264 @@
+from bizsval import Company, source_handler, source_tickers, load_market_caps, load_blacklist, window, MARKET_CAPS, BLACKLIST
+from biznesradar_scraper import INCOME, BALANCE, CASH
+from instrument import METRICS, log
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from bisect import bisect_left, bisect_right, insort
+import threading
+import heapq
+import math
+import json
+import time
+import sys
+import os
+
+PORT = 8765
+POLL = 2 # seconds between checks of the data files for changes
+LIMIT = 20
+INDEXED = ("roe", "roe_deviation", "margin", "debt_to_assets", "positive_earnings", "intrinsic_value", "market_cap", "uvf")
+
+def company_metrics(c, market_cap=None, years_back=5, discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02):
+    '''Metrics of a company kept by a ScreenIndex, those that can not be computed (e.g. intrinsic value
+    with negative equity or undervaluation factor without a market cap) are left out'''
+    def attempt(func):
+        try:
+            return func()
+        except Exception:
+            return None
+
+    metrics = {}
+    metrics["roe"], metrics["roe_deviation"] = attempt(lambda: c.metric("roe", *window(c.financials, years_back))) or (None, None)
+    metrics["margin"] = attempt(lambda: c.calc_margin(years_back=years_back))
+    metrics["debt_to_assets"] = attempt(c.calc_debt_to_assets_current)
+    metrics["positive_earnings"] = attempt(lambda: float(c.chk_pos("net_income", years_back=years_back)))
+    metrics["intrinsic_value"] = attempt(lambda: c.intrinsic_value(discount_rate, years_back, projection_length, growth_cap, terminal_growth))
+    metrics["market_cap"] = market_cap or None
+    if metrics["intrinsic_value"] is not None and market_cap:
+        metrics["uvf"] = metrics["intrinsic_value"] / market_cap
+    return {m: v for m, v in metrics.items() if v is not None and math.isfinite(v)}
+
+class ScreenIndex:
+    '''Companies of a source kept in memory with their metrics (INDEXED, see company_metrics) and one
+    sorted index per metric, answers range and top-N queries. refresh() reloads only tickers whose
+    data files changed and updates market caps when the market cap cache file changed'''
+    def __init__(self, source, tickers=None, data_dir=None, blacklist_dir=BLACKLIST, market_cap_cache=MARKET_CAPS,
+                 years_back=5, discount_rate=0.065, projection_length=5, growth_cap=0.1, terminal_growth=0.02):
+        self.source = source
+        self.dir = data_dir or f"data/{source}"
+        self.handler = source_handler(source, self.dir)
+        blacklist = load_blacklist(blacklist_dir) if blacklist_dir else []
+        self.tickers = [t for t in tickers or source_tickers(source) if t not in blacklist]
+        self.market_cap_cache = market_cap_cache
+        self.params = (years_back, discount_rate, projection_length, growth_cap, terminal_growth)
+        self.lock = threading.RLock()
+        self.companies = {}
+        self.metrics = {}
+        self.indexes = {m: [] for m in INDEXED}
+        self.stamps = {}
+        self.caps = {}
+        self.caps_stamp = None
+        self.refreshed = None
+        self.refresh()
+
+    def files(self, ticker):
+        if self.source == "gpw":
+            return [f"{ticker}-{statement}.json" for statement in (INCOME, BALANCE, CASH)]
+        return [f"{ticker}.json"]
+
+    def market_cap(self, ticker):
+        if self.handler.caps_with_financials and ticker in self.handler.market_caps:
+            return self.handler.market_caps[ticker]
+        entry = self.caps.get(f"{self.handler.source}/{ticker}")
+        return entry[0] if entry else None
+
+    def refresh(self):
+        '''Reloads tickers whose files were modified, added or removed since the last refresh (all of
+        them the first time), returns the list of reloaded tickers'''
+        with METRICS.timer("refresh"), self.lock:
+            try:
+                mtimes = {e.name: e.stat().st_mtime_ns for e in os.scandir(self.dir) if e.name.endswith(".json")}
+            except FileNotFoundError:
+                mtimes = {}
+            changed = []
+            for t in self.tickers:
+                stamp = tuple(mtimes.get(f) for f in self.files(t))
+                if stamp != self.stamps.get(t):
+                    self.stamps[t] = stamp
+                    changed.append(t)
+            caps_stamp = os.stat(self.market_cap_cache).st_mtime_ns if self.market_cap_cache and os.path.exists(self.market_cap_cache) else None
+            caps_changed = caps_stamp != self.caps_stamp
+            if caps_changed:
+                self.caps_stamp = caps_stamp
+                self.caps = load_market_caps(self.market_cap_cache) if caps_stamp else {}
+            for t in changed:
+                self.load(t)
+            if caps_changed:
+                reloaded = set(changed)
+                for t, c in list(self.companies.items()):
+                    if t not in reloaded and self.market_cap(t) != self.metrics[t].get("market_cap"):
+                        self.put(t, company_metrics(c, self.market_cap(t), *self.params))
+            self.refreshed = time.time()
+        if changed:
+            METRICS.count("reloaded", len(changed))
+            log.info("reloaded %d tickers", len(changed))
+        return changed
+
+    def load(self, ticker):
+        try:
+            c = Company(ticker, self.handler)
+            c.set_financials()
+            metrics = company_metrics(c, self.market_cap(ticker), *self.params)
+        except Exception as e:
+            METRICS.count("load errors")
+            log.warning("An error occurred while initializing company: %s : %s", ticker, e)
+            self.remove(ticker)
+            return
+        with self.lock:
+            self.companies[ticker] = c
+            self.put(ticker, metrics)
+
+    def put(self, ticker, metrics):
+        with self.lock:
+            self.remove(ticker, keep_company=True)
+            self.metrics[ticker] = metrics
+            for m, value in metrics.items():
+                insort(self.indexes[m], (value, ticker))
+
+    def remove(self, ticker, keep_company=False):
+        with self.lock:
+            for m, value in self.metrics.pop(ticker, {}).items():
+                index = self.indexes[m]
+                del index[bisect_left(index, (value, ticker))]
+            if not keep_company:
+                self.companies.pop(ticker, None)
+
+    def span(self, metric, low=None, high=None):
+        '''Bounds of the entries of a sorted index with low <= value <= high'''
+        index = self.indexes[metric]
+        start = bisect_left(index, (low,)) if low is not None else 0
+        end = bisect_right(index, (high, chr(0x10ffff))) if high is not None else len(index)
+        return start, end
+
+    def query(self, conditions=(), sort="uvf", descending=True, limit=LIMIT):
+        '''Companies with every metric of conditions - (metric, low, high) tuples, None for an open end,
+        bounds inclusive - in range, sorted by a metric (companies without it are left out) and cut
+        to limit. Candidates come from the narrowest range of the sorted indexes. Returns the number
+        of matches and the rows of the selected companies'''
+        for metric, _, _ in conditions:
+            if metric not in self.indexes:
+                raise KeyError(metric)
+        if sort and sort not in self.indexes:
+            raise KeyError(sort)
+        with METRICS.timer("query"), self.lock:
+            ranges = [(self.span(m, low, high), m) for m, low, high in conditions]
+            if sort:
+                ranges.append((self.span(sort), sort))
+            if ranges:
+                (start, end), metric = min(ranges, key=lambda r: r[0][1] - r[0][0])
+                candidates = [t for _, t in self.indexes[metric][start:end]]
+            else:
+                candidates = sorted(self.metrics)
+            matches = []
+            for t in candidates:
+                metrics = self.metrics[t]
+                if sort and sort not in metrics:
+                    continue
+                for m, low, high in conditions:
+                    value = metrics.get(m)
+                    if value is None or (low is not None and value < low) or (high is not None and value > high):
+                        break
+                else:
+                    matches.append(t)
+            if sort:
+                key = lambda t: self.metrics[t][sort]
+                top = (heapq.nlargest if descending else heapq.nsmallest)(limit, matches, key) if limit else sorted(matches, key=key, reverse=descending)
+            else:
+                top = matches[:limit] if limit else matches
+            return {"count": len(matches), "results": [dict(name=t, **self.metrics[t]) for t in top]}
+
+    def status(self):
+        with self.lock:
+            return {"source": self.source, "tickers": len(self.tickers), "companies": len(self.companies),
+                    "indexed": {m: len(index) for m, index in self.indexes.items()}, "refreshed": self.refreshed,
+                    "metrics": METRICS.snapshot()}
+
+def parse_query(params):
+    '''Arguments of ScreenIndex.query from URL parameters - {metric}_min and {metric}_max bounds,
+    sort (a metric or "none"), order ("desc" or "asc") and limit (0 for all)'''
+    bounds = {}
+    for name, values in params.items():
+        if name in ("sort", "order", "limit"):
+            continue
+        metric, _, end = name.rpartition("_")
+        if end not in ("min", "max"):
+            raise KeyError(name)
+        low, high = bounds.get(metric, (None, None))
+        value = float(values[-1])
+        bounds[metric] = (value, high) if end == "min" else (low, value)
+    sort = params.get("sort", ["uvf"])[-1]
+    return ([(m, low, high) for m, (low, high) in bounds.items()], None if sort == "none" else sort,
+            params.get("order", ["desc"])[-1] != "asc", int(params.get("limit", [LIMIT])[-1]))
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''JSON API of a ScreenIndex - GET /query?roe_min=0.15&roe_deviation_max=0.5&sort=uvf&limit=20,
+    /company/{ticker}, /status and /refresh'''
+    def do_GET(self):
+        url = urlparse(self.path)
+        index = self.server.index
+        try:
+            if url.path == "/query":
+                start = time.perf_counter()
+                result = index.query(*parse_query(parse_qs(url.query)))
+                result["ms"] = (time.perf_counter() - start) * 1000
+                self.reply(200, result)
+            elif url.path.startswith("/company/"):
+                ticker = url.path[len("/company/"):]
+                with index.lock:
+                    metrics = index.metrics.get(ticker)
+                if metrics is None:
+                    self.reply(404, {"error": f"unknown ticker {ticker}"})
+                else:
+                    self.reply(200, dict(name=ticker, **metrics))
+            elif url.path == "/status":
+                self.reply(200, index.status())
+            elif url.path == "/refresh":
+                self.reply(200, {"reloaded": index.refresh()})
+            else:
+                self.reply(404, {"error": f"unknown path {url.path}"})
+        except (KeyError, ValueError) as e:
+            self.reply(400, {"error": f"bad query: {e}"})
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+def watch(index, stop, poll=POLL):
+    '''Refreshes the index every poll seconds until stop is set'''
+    while not stop.wait(poll):
+        try:
+            index.refresh()
+        except Exception as e:
+            log.warning("refresh failed: %s", e)
+
+def serve(index, host="127.0.0.1", port=PORT, poll=POLL):
+    '''Serves queries of a ScreenIndex over HTTP on host:port (local only by default) until
+    interrupted, the data files are checked for changes every poll seconds'''
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.index = index
+    stop = threading.Event()
+    threading.Thread(target=watch, args=(index, stop, poll), daemon=True).start()
+    print(f"serving {len(index.companies)} companies on http://{host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
@@ -0,0 +1,470 @@
+from instrument import log
+import numpy as np
+import statistics
+import csv
+
+FIELDS = ("equity", "net_income", "dividend", "revenue", "assets", "liabilities")
+PERCENTILES = (5, 25, 50, 75, 95)
+MIN_SPREAD = 0.01 # sampled discount rates are kept at least this much above terminal growth
+PEER_METRICS = {"roe": "ROE", "margin": "Margin", "debt_to_assets": "Debt to Assets", "uvf": "Undervaluation Factor"}
+PEER_STATS = {"median": "Sector Median", "percentile": "Sector Percentile", "z": "Sector Z"}
+OFFLINE_PEER_METRICS = ("roe", "margin", "debt_to_assets") # peer metrics that need no market caps
+MIN_PEERS = 3 # smallest group with peer stats
+
+EXTENDED = np.finfo(np.longdouble).nmant > 52 # longdouble is float64 on e.g. MSVC builds
+EPS = float(np.finfo(np.longdouble).eps) / 2 # unit roundoff of longdouble
+
+def rounds_alike(q, err):
+    '''Mask of longdouble values q that round to the same float as every value within err of them,
+    non-finite ones included'''
+    m = q.astype(float)
+    with np.errstate(invalid="ignore"):
+        low = (m.astype(np.longdouble) + np.nextafter(m, -np.inf)) / 2
+        high = (m.astype(np.longdouble) + np.nextafter(m, np.inf)) / 2
+        return ~np.isfinite(q) | ((q - err > low) & (q + err < high))
+
+def exact_mean(values, mask=None):
+    '''Row means (of the masked values if a mask is given) equal to statistics.mean - accumulated in
+    extended precision, rows whose rounding is not certain within the error bound of that are
+    computed by statistics.mean, as are all rows where longdouble is no wider than float'''
+    if mask is None:
+        mask = np.ones(values.shape, dtype=bool)
+    count = mask.sum(axis=1)
+    result = np.full(len(values), np.nan)
+    exact = np.zeros(len(values), dtype=bool)
+    if EXTENDED:
+        x = np.where(mask, values, 0).astype(np.longdouble)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            q = x.sum(axis=1) / count
+            err = 2 * EPS * (np.abs(x).sum(axis=1) + np.abs(q))
+        result = q.astype(float)
+        exact = rounds_alike(q, err) | (count == 0)
+    for i in np.flatnonzero(~exact):
+        result[i] = statistics.mean(values[i][mask[i]].tolist()) if count[i] else np.nan
+    return result
+
+def exact_stdev(values):
+    '''Row sample standard deviations equal to statistics.stdev, computed like exact_mean'''
+    n = values.shape[1]
+    result = np.full(len(values), np.nan)
+    exact = np.zeros(len(values), dtype=bool)
+    if EXTENDED:
+        x = values.astype(np.longdouble)
+        deviations = x - x.sum(axis=1, keepdims=True) / n
+        ss = (deviations ** 2).sum(axis=1)
+        sd = np.sqrt(ss / (n - 1))
+        # each deviation is off by at most delta, the sum of squares by err_ss
+        delta = (n + 2) * EPS * np.abs(x).max(axis=1)
+        err_ss = 2 * delta * np.abs(deviations).sum(axis=1) + n * delta ** 2 + (n + 1) * EPS * ss
+        with np.errstate(invalid="ignore", divide="ignore"):
+            err = 4 * (err_ss / (n - 1) / (2 * sd) + EPS * sd)
+        result = sd.astype(float)
+        exact = rounds_alike(sd, err) & (sd > 0) | (~np.isfinite(sd))
+    for i in np.flatnonzero(~exact):
+        result[i] = statistics.stdev(values[i].tolist())
+    return result
+
+def group_stats(groups, values, min_peers=MIN_PEERS):
+    '''Peer stats of values within groups in one sorted pass - groups are integer codes (negative for
+    no group), one per value. Returns a dict of arrays aligned with values - "median" of the group,
+    "percentile" rank in the group (0 for the lowest value, 100 for the highest, ties share the
+    mean rank), "z" score against the group mean and sample deviation, and "peers" - number of
+    values in the group. NaN values take no part and get NaN stats, as do groups with less than 
+    min_peers values'''
+    groups = np.asarray(groups)
+    values = np.asarray(values, dtype=float)
+    stats = {name: np.full(len(values), np.nan) for name in ("median", "percentile", "z")}
+    stats["peers"] = np.zeros(len(values), dtype=int)
+    idx = np.flatnonzero(~np.isnan(values) & (groups >= 0))
+    if not len(idx):
+        return stats
+    order = np.lexsort((values[idx], groups[idx]))
+    idx = idx[order]
+    g = groups[idx]
+    v = values[idx]
+    counts = np.bincount(g)
+    starts = np.cumsum(counts) - counts
+    # runs of equal values within a group share the mean of their positions
+    new_run = np.ones(len(v), dtype=bool)
+    new_run[1:] = (g[1:] != g[:-1]) | (v[1:] != v[:-1])
+    run = np.cumsum(new_run) - 1
+    run_first = np.flatnonzero(new_run)
+    run_last = np.append(run_first[1:], len(v)) - 1
+    rank = (run_first[run] + run_last[run]) / 2 - starts[g]
+    n = counts[g]
+    present = counts > 0
+    medians = np.full(len(counts), np.nan)
+    medians[present] = (v[(starts + (counts - 1) // 2)[present]] + v[(starts + counts // 2)[present]]) / 2
+    means = np.bincount(g, v) / np.maximum(counts, 1)
+    squares = np.bincount(g, (v - means[g]) ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deviations = np.sqrt(squares / (counts - 1))
+        ok = n >= max(min_peers, 2)
+        stats["median"][idx] = np.where(ok, medians[g], np.nan)
+        stats["percentile"][idx] = np.where(ok, rank / (n - 1) * 100, np.nan)
+        stats["z"][idx] = np.where(ok & (deviations[g] > 0), (v - means[g]) / deviations[g], np.nan)
+    stats["peers"][idx] = n
+    return stats
+
+def discount_factors(discount_rate, length):
+    '''(1 + discount_rate) ** year for years 1 to length, computed on python floats to round 
+    the same way as Company.calc_iv, shaped discount_rate.shape + (length,)'''
+    rates = np.asarray(discount_rate, dtype=float)
+    factors = [[(1 + float(r)) ** i for i in range(1, length + 1)] for r in rates.ravel()]
+    return np.array(factors).reshape(rates.shape + (length,))
+
+class Screener:
+    '''Batch counterpart of Company methods, financials of all companies are held as aligned
+    (companies x years) arrays padded with NaN past the length of each series. Methods take the
+    same arguments as their Company equivalents and return one value per company, NaN where the
+    Company method would raise an exception. Metrics are cached per window, so re-screening
+    with different thresholds only repeats the comparisons'''
+    def __init__(self, companies):
+        self.names = [c.name for c in companies]
+        self.n = len(companies)
+        width = max([len(c.financials.get(f, [])) for c in companies for f in FIELDS] + [1])
+        self.data = {}
+        self.lengths = {}
+        for f in FIELDS:
+            values = np.full((self.n, width), np.nan)
+            lengths = np.zeros(self.n, dtype=int)
+            for row, c in enumerate(companies):
+                series = c.financials.get(f, [])
+                values[row, :len(series)] = series
+                lengths[row] = len(series)
+            self.data[f] = values
+            self.lengths[f] = lengths
+        self.market_caps = np.array([c.market_cap or 0 for c in companies], dtype=float)
+        self.sectors = np.full(self.n, -1)
+        self.sector_names = np.array([], dtype=str)
+        self.cache = {}
+
+    def set_market_caps(self, market_caps):
+        '''market_caps - dict of name: market cap, missing names are set to 0'''
+        self.market_caps = np.array([market_caps.get(name) or 0 for name in self.names], dtype=float)
+        self.cache = {k: v for k, v in self.cache.items() if k[0] not in ("uvf", "peers")}
+
+    def set_sectors(self, sectors):
+        '''sectors - dict of name: sector, the peer group of a company, those without one get no peer stats'''
+        labels = np.array([sectors.get(name) or "" for name in self.names], dtype=str)
+        self.sector_names, codes = np.unique(labels, return_inverse=True)
+        self.sectors = np.where(labels == "", -1, codes)
+        self.cache = {k: v for k, v in self.cache.items() if k[0] != "peers"}
+
+    def window(self, years_back):
+        '''Indexes of years used by Company methods called with years_back - from 
+        len(net_income) - years_back to len(net_income), as python indexes (may be negative)'''
+        return self.lengths["net_income"][:, None] - years_back + np.arange(years_back)
+
+    def take(self, field, idx):
+        '''Gathers values at python indexes, negative ones counted from the end of each series,
+        returns values and a mask of indexes that would not raise IndexError'''
+        lengths = self.lengths[field][:, None]
+        pos = np.where(idx < 0, idx + lengths, idx)
+        valid = (pos >= 0) & (pos < lengths)
+        values = np.take_along_axis(self.data[field], np.clip(pos, 0, self.data[field].shape[1] - 1), axis=1)
+        return np.where(valid, values, np.nan), valid
+
+    def take_slice(self, field, years_back):
+        '''Values and mask of series[len(series) - years_back:len(series)]'''
+        lengths = self.lengths[field][:, None]
+        start = np.maximum(lengths - years_back, 0)
+        start = np.where(lengths - years_back < 0, np.maximum(2 * lengths - years_back, 0), start)
+        pos = np.arange(self.data[field].shape[1])
+        mask = (pos >= start) & (pos < lengths)
+        return self.data[field], mask
+
+    def cached(self, key, func):
+        if key not in self.cache:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                self.cache[key] = func()
+        return self.cache[key]
+
+    def chk_pos(self, element_of_financials, years_back):
+        def calc():
+            values, mask = self.take_slice(element_of_financials, years_back)
+            return np.where(mask, values > 0, True).all(axis=1)
+        return self.cached(("pos", element_of_financials, years_back), calc)
+
+    def calc_margin(self, years_back):
+        def calc():
+            idx = self.window(years_back)
+            income, v1 = self.take("net_income", idx)
+            revenue, v2 = self.take("revenue", idx)
+            valid = (v1 & v2 & (revenue != 0)).all(axis=1)
+            return np.where(valid, exact_mean(income / revenue), np.nan)
+        return self.cached(("margin", years_back), calc)
+
+    def mean_roe(self, years_back):
+        '''Returns mean ROE and ROE deviation (stdev / mean)'''
+        def calc():
+            idx = self.window(years_back)
+            equity, v1 = self.take("equity", idx)
+            income, v2 = self.take("net_income", idx)
+            valid = (v1 & v2 & (equity > 0)).all(axis=1)
+            roes = np.where(income == 0, 0, income / equity)
+            roe = exact_mean(roes)
+            deviation = exact_stdev(roes) / roe if years_back > 1 else np.full(self.n, np.nan)
+            valid &= np.isfinite(deviation)
+            return np.where(valid, roe, np.nan), np.where(valid, deviation, np.nan)
+        return self.cached(("roe", years_back), calc)
+
+    def mean_pr(self, years_back):
+        def calc():
+            idx = self.window(years_back)
+            income, v1 = self.take("net_income", idx - 1)
+            dividend, v2 = self.take("dividend", idx)
+            valid = (v1 & v2).all(axis=1)
+            paid = income > 0
+            count = paid.sum(axis=1)
+            pr = exact_mean(dividend / income, paid)
+            return np.where(valid, np.where(count > 1, pr, 0), np.nan)
+        return self.cached(("pr", years_back), calc)
+
+    def estimate_growth(self, years_back):
+        def calc():
+            roe = self.mean_roe(years_back)[0]
+            pr = self.mean_pr(years_back)
+            growth = np.where((pr < 0) | (roe < 0) | (pr > 1), 0, roe * (1 - pr))
+            return np.where(np.isnan(roe) | np.isnan(pr), np.nan, growth)
+        return self.cached(("growth", years_back), calc)
+
+    def mean_income(self, years_back):
+        def calc():
+            values, mask = self.take_slice("net_income", years_back)
+            return exact_mean(values, mask)
+        return self.cached(("income", years_back), calc)
+
+    def estimate_income_classic(self, projection_length, growth_cap, years_back):
+        '''Returns projected incomes as a (companies x projection_length) array'''
+        def calc():
+            gr = self.estimate_growth(years_back)
+            gr = np.where(gr > growth_cap, growth_cap, gr)
+            factors = np.repeat((1 + gr)[:, None], projection_length + 1, axis=1)
+            factors[:, 0] = self.mean_income(years_back)
+            incomes = np.cumprod(factors, axis=1)[:, 1:]
+            return incomes / (1 + (np.arange(projection_length) + 1) * 0.03)
+        return self.cached(("projection", projection_length, growth_cap, years_back), calc)
+
+    def calc_iv(self, discount_rate, projected_income, terminal_growth):
+        len_ = projected_income.shape[-1]
+        discounted = projected_income / discount_factors(discount_rate, len_)
+        terminal_value = projected_income[..., len_ - 1] / (discount_rate - terminal_growth)
+        return np.cumsum(discounted, axis=-1)[..., -1] + terminal_value
+
+    def calc_uvf(self, discount_rate, years_back, projection_length=5, growth_cap=0.1, terminal_growth=0.02):
+        def calc():
+            projected = self.estimate_income_classic(projection_length, growth_cap, years_back)
+            iv = self.calc_iv(discount_rate, projected, terminal_growth)
+            valid = (self.lengths["equity"] > 0) & (self.market_caps != 0)
+            return np.where(valid, iv / self.market_caps, np.nan)
+        return self.cached(("uvf", discount_rate, years_back, projection_length, growth_cap, terminal_growth), calc)
+
+    def uvf_grid(self, discount_rates, growth_caps, terminal_growths, projection_lengths, years_back=5):
+        '''Undervaluation factor of every company for every combination of valuation parameters,
+        broadcast in one pass, returns an array shaped (companies, discount rates, growth caps, 
+        terminal growths, projection lengths), entries equal calc_uvf with the same parameters'''
+        discount_rates = np.asarray(discount_rates, dtype=float)
+        growth_caps = np.asarray(growth_caps, dtype=float)
+        terminal_growths = np.asarray(terminal_growths, dtype=float)
+        length = max(projection_lengths)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gr = self.estimate_growth(years_back)[:, None]
+            gr = np.where(gr > growth_caps, growth_caps, gr)
+            factors = np.repeat((1 + gr)[:, :, None], length + 1, axis=2)
+            factors[:, :, 0] = self.mean_income(years_back)[:, None]
+            incomes = np.cumprod(factors, axis=2)[:, :, 1:] / (1 + (np.arange(length) + 1) * 0.03)
+            # (companies, discount rates, growth caps, years)
+            discounted = np.cumsum(incomes[:, None] / discount_factors(discount_rates, length)[None, :, None], axis=3)
+            spreads = discount_rates[:, None] - terminal_growths[None, :]
+            ivs = []
+            for p in projection_lengths:
+                terminal_value = incomes[:, None, :, None, p - 1] / spreads[None, :, None, :]
+                ivs.append(discounted[..., p - 1, None] + terminal_value)
+            iv = np.stack(ivs, axis=-1)
+            valid = (self.lengths["equity"] > 0) & (self.market_caps != 0)
+            caps = self.market_caps[:, None, None, None, None]
+            return np.where(valid[:, None, None, None, None], iv / caps, np.nan)
+
+    def payout_deviation(self, years_back):
+        '''Sample standard deviation of the yearly payout ratios averaged by mean_pr, 0 where mean_pr 
+        has less than two of them'''
+        def calc():
+            idx = self.window(years_back)
+            income, _ = self.take("net_income", idx - 1)
+            dividend, _ = self.take("dividend", idx)
+            paid = income > 0
+            count = paid.sum(axis=1)
+            ratios = np.where(paid, dividend / income, 0)
+            mean = ratios.sum(axis=1) / count
+            squares = np.where(paid, (ratios - mean[:, None]) ** 2, 0).sum(axis=1)
+            return np.where(count > 1, np.sqrt(squares / (count - 1)), 0)
+        return self.cached(("pr deviation", years_back), calc)
+
+    def monte_carlo(self, years_back=5, paths=10000, discount_rate=0.065, discount_deviation=0.01, projection_length=5,
+                    growth_cap=0.1, terminal_growth=0.02, percentiles=PERCENTILES, chunk_size=None, seed=None):
+        '''Probabilistic calc_uvf - for every company "paths" valuations with ROE, payout ratio and discount
+        rate drawn from normal distributions around their means, with the historical standard deviations
+        of ROE and payout ratio and discount_deviation. Each path projects incomes like 
+        estimate_income_classic with the growth of estimate_growth and values them like calc_iv. 
+        Companies are processed in chunks of arrays shaped (chunk_size, paths). Returns a dict of 
+        intrinsic value percentiles (companies x percentiles), mean intrinsic value and the share of 
+        paths with undervaluation factor above 1 (NaN without a market cap), all NaN for companies 
+        calc_uvf can not value'''
+        roe, deviation = self.mean_roe(years_back)
+        with np.errstate(invalid="ignore"):
+            roe_sd = np.abs(deviation * roe)
+        pr = self.mean_pr(years_back)
+        pr_sd = self.payout_deviation(years_back)
+        base = self.mean_income(years_back)
+        rng = np.random.default_rng(seed)
+        chunk_size = chunk_size or max(1, 2 ** 22 // paths)
+        ivs = np.full((self.n, len(percentiles)), np.nan)
+        means = np.full(self.n, np.nan)
+        undervalued = np.full(self.n, np.nan)
+        valid = np.flatnonzero(~np.isnan(roe) & ~np.isnan(pr) & ~np.isnan(base) & (self.lengths["equity"] > 0))
+        for start in range(0, len(valid), chunk_size):
+            rows = valid[start:start + chunk_size]
+            shape = (len(rows), paths)
+            roes = roe[rows, None] + roe_sd[rows, None] * rng.standard_normal(shape)
+            prs = pr[rows, None] + pr_sd[rows, None] * rng.standard_normal(shape)
+            rates = np.maximum(discount_rate + discount_deviation * rng.standard_normal(shape), terminal_growth + MIN_SPREAD)
+            growth = np.where((prs < 0) | (roes < 0) | (prs > 1), 0, roes * (1 - prs))
+            growth = np.minimum(growth, growth_cap)
+            income = np.repeat(base[rows, None], paths, axis=1)
+            discount = np.ones(shape)
+            iv = np.zeros(shape)
+            for year in range(1, projection_length + 1):
+                income *= 1 + growth
+                discount *= 1 + rates
+                projected = income / (1 + year * 0.03)
+                iv += projected / discount
+            iv += projected / (rates - terminal_growth)
+            ivs[rows] = np.percentile(iv, percentiles, axis=1).T
+            means[rows] = iv.mean(axis=1)
+            caps = self.market_caps[rows, None]
+            undervalued[rows] = np.where(caps[:, 0] != 0, (iv > caps).mean(axis=1), np.nan)
+        return {"percentiles": tuple(percentiles), "iv": ivs, "mean": means, "p_undervalued": undervalued}
+
+    def calc_debt_to_assets_current(self):
+        def calc():
+            last = np.full((self.n, 1), -1)
+            liabilities, v1 = self.take("liabilities", last)
+            assets, v2 = self.take("assets", last)
+            valid = (v1 & v2 & (assets != 0))[:, 0]
+            return np.where(valid, (liabilities / assets)[:, 0], np.nan)
+        return self.cached(("debt_to_assets",), calc)
+
+    def peer_stats(self, years_back=5, discount_rate=0.065, min_peers=MIN_PEERS, projection_length=5, growth_cap=0.1,
+                   terminal_growth=0.02):
+        '''group_stats of PEER_METRICS within sectors (see set_sectors) as {metric: {stat: array}} - 
+        mean ROE and margin over years_back, current debt to assets and calc_uvf (NaN without market caps)'''
+        def calc():
+            values = {"roe": self.mean_roe(years_back)[0],
+                      "margin": self.calc_margin(years_back),
+                      "debt_to_assets": self.calc_debt_to_assets_current(),
+                      "uvf": self.calc_uvf(discount_rate, years_back, projection_length, growth_cap, terminal_growth)}
+            return {metric: group_stats(self.sectors, v, min_peers) for metric, v in values.items()}
+        return self.cached(("peers", years_back, discount_rate, min_peers, projection_length, growth_cap, terminal_growth), calc)
+
+    def peer_screen(self, peer_filters, years_back=5, discount_rate=0.065, min_peers=MIN_PEERS, projection_length=5,
+                    growth_cap=0.1, terminal_growth=0.02):
+        '''Mask of companies passing peer filters - (metric, stat, low, high) tuples, a metric of PEER_METRICS
+        and stat of PEER_STATS, None for an open end, bounds inclusive. Companies without the stat fail'''
+        stats = self.peer_stats(years_back, discount_rate, min_peers, projection_length, growth_cap, terminal_growth)
+        passed = np.ones(self.n, dtype=bool)
+        with np.errstate(invalid="ignore"):
+            for metric, stat, low, high in peer_filters:
+                values = stats[metric][stat]
+                if low is not None:
+                    passed &= values >= low
+                if high is not None:
+                    passed &= values <= high
+        return passed
+
+    def peer_row(self, i, stats, metrics=PEER_METRICS):
+        '''Sector and peer stats of metrics of company i as result columns, see peer_fields'''
+        row = {"Sector": str(self.sector_names[self.sectors[i]]) if self.sectors[i] >= 0 else ""}
+        for metric in metrics:
+            for stat, stat_label in PEER_STATS.items():
+                row[f"{PEER_METRICS[metric]} {stat_label}"] = float(stats[metric][stat][i])
+        return row
+
+    def screen(self, margin_filter, roe_filter, roe_deviation_filter, filter_backyears):
+        '''Mask of companies passing the filters of eval_stocks'''
+        with np.errstate(invalid="ignore"):
+            passed = self.chk_pos("net_income", 5).copy()
+            if margin_filter:
+                passed &= self.calc_margin(filter_backyears) >= margin_filter
+            if roe_filter:
+                roe, deviation = self.mean_roe(filter_backyears)
+                passed &= roe >= roe_filter
+                # eval_stocks reads the deviation left behind by the ROE filter
+                if roe_deviation_filter:
+                    passed &= ~(deviation > roe_deviation_filter)
+        return passed
+
+    def results(self, passed, margin_filter, filter_backyears, discount_rate=0.065, years_back=5, peers=None,
+                projection_length=5, growth_cap=0.1, terminal_growth=0.02):
+        '''Result rows of eval_stocks for companies in the passed mask with a successful valuation,
+        with peer_row columns if peer_stats are given'''
+        uvf = self.calc_uvf(discount_rate, years_back, projection_length, growth_cap, terminal_growth)
+        roe, deviation = self.mean_roe(years_back)
+        margin = self.calc_margin(filter_backyears) if margin_filter else None
+        debt_to_assets = self.calc_debt_to_assets_current()
+        ok = passed & ~np.isnan(uvf) & ~np.isnan(debt_to_assets)
+        results = []
+        for i in np.flatnonzero(ok):
+            results.append({
+                "Name": self.names[i],
+                "Undervaluation Factor": float(uvf[i]),
+                "ROE": float(roe[i]),
+                "Margin": float(margin[i]) if margin_filter else 0,
+                "ROE Deviation": float(deviation[i]),
+                "Debt to Assets": float(debt_to_assets[i])
+            })
+            if peers:
+                results[-1].update(self.peer_row(i, peers))
+        return results
+
+def peer_fields(metrics=PEER_METRICS):
+    '''Names of the columns added by Screener.peer_row'''
+    return ["Sector"] + [f"{PEER_METRICS[metric]} {stat}" for metric in metrics for stat in PEER_STATS.values()]
+
+def robustness(grid):
+    '''Per-company stats of a uvf_grid - min, median, max and share of parameter combinations
+    with undervaluation factor above 1'''
+    flat = grid.reshape(grid.shape[0], -1)
+    with np.errstate(invalid="ignore"):
+        return {"Min": flat.min(axis=1),
+                "Median": np.median(flat, axis=1),
+                "Max": flat.max(axis=1),
+                "Share Undervalued": (flat > 1).mean(axis=1)}
+
+def save_sensitivity(path, names, grid, axes, mask=None):
+    '''Saves a uvf_grid as {path}.npz (grid, company names and parameter axes) and robustness 
+    stats as {path}.csv, mask - optional selection of companies to save'''
+    names = np.array(names)
+    if mask is not None:
+        names = names[mask]
+        grid = grid[mask]
+    np.savez_compressed(f"{path}.npz", uvf=grid, names=names, **{k: np.asarray(v) for k, v in axes.items()})
+    stats = robustness(grid)
+    with open(f"{path}.csv", mode="w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Name"] + list(stats))
+        for i, name in enumerate(names):
+            writer.writerow([name] + [float(v[i]) for v in stats.values()])
+    log.info("Sensitivity grid saved to %s.npz and %s.csv", path, path)
+
+def save_monte_carlo(path, names, result, mask=None):
+    '''Saves a Screener.monte_carlo result as {path}.csv - intrinsic value percentiles, mean and
+    probability of undervaluation factor above 1 per company, mask - optional selection of companies'''
+    keep = np.ones(len(names), dtype=bool) if mask is None else mask
+    with open(f"{path}.csv", mode="w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Name"] + [f"IV P{p}" for p in result["percentiles"]] + ["Mean IV", "P(UVF > 1)"])
+        for i in np.flatnonzero(keep):
+            writer.writerow([names[i]] + [float(v) for v in result["iv"][i]] + 
+                            [float(result["mean"][i]), float(result["p_undervalued"][i])])
+    log.info("Monte Carlo valuation saved to %s.csv", path)
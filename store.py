@@ -0,0 +1,181 @@
+import biznesradar_scraper as br
+from instrument import log, verbose
+import sqlite3
+import threading
+import json
+import os
+from glob import glob
+
+STORE = "data/financials.db"
+
+class FinStore:
+    '''Single file store of scraped financials of every source, replaces reading one JSON file 
+    per ticker and statement. Every field of a ticker is one row holding its JSON encoded value (a
+    whole series or a single value), a source ("gpw" for biznesradar, "gf" for Google Finance, by 
+    default the name of the directory the JSON files came from) is read with one query the first 
+    time any of its tickers is requested and a ticker is decoded when it is requested. 
+    
+    Runs of bizsval.incremental_eval_stocks keep dated snapshots here - the version of the financials
+    (by hash, each distinct version stored once) and market cap of every ticker, and its valuation 
+    with a given set of parameters, see put_snapshot and uvf_history'''
+    def __init__(self, path=STORE):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.cache = {}
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS fields (
+                source TEXT, ticker TEXT, field TEXT, value TEXT,
+                PRIMARY KEY (source, ticker, field)) WITHOUT ROWID''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS versions (
+                hash TEXT PRIMARY KEY, data TEXT) WITHOUT ROWID''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS snapshots (
+                source TEXT, ticker TEXT, day TEXT, hash TEXT, market_cap,
+                PRIMARY KEY (source, ticker, day)) WITHOUT ROWID''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS valuations (
+                source TEXT, ticker TEXT, params TEXT, day TEXT, hash TEXT, status TEXT, intrinsic_value, 
+                uvf, roe, margin, roe_deviation, debt_to_assets,
+                PRIMARY KEY (source, ticker, params, day)) WITHOUT ROWID''')
+
+    def __getstate__(self):
+        # connections don't pickle, worker processes open their own
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def load(self, source):
+        '''Reads all tickers of a source into memory, as a dict of ticker: list of (field, JSON encoded
+        value)'''
+        data = {}
+        with self.lock:
+            rows = self.conn.execute("SELECT ticker, field, value FROM fields WHERE source = ?", (source,))
+            for ticker, field, value in rows:
+                data.setdefault(ticker, []).append((field, value))
+            self.cache[source] = data
+        return data
+
+    def get(self, source, ticker):
+        '''Returns the raw financials of a ticker in the same shape as its JSON files'''
+        if source not in self.cache:
+            self.load(source)
+        try:
+            fields = self.cache[source][ticker]
+        except KeyError:
+            raise KeyError(f"{ticker} not found in {self.path} ({source})")
+        return {field: json.loads(value) for field, value in fields}
+
+    def tickers(self, source):
+        if source not in self.cache:
+            self.load(source)
+        return list(self.cache[source])
+
+    def put(self, source, ticker, data, commit=True):
+        '''Replaces everything stored for a ticker with a dict of lists (series) and single values'''
+        fields = [(field, json.dumps(value)) for field, value in data.items()]
+        with self.lock:
+            self.conn.execute("DELETE FROM fields WHERE source = ? AND ticker = ?", (source, ticker))
+            self.conn.executemany("INSERT INTO fields VALUES (?, ?, ?, ?)", 
+                                  [(source, ticker, field, value) for field, value in fields])
+            if commit:
+                self.conn.commit()
+            if source in self.cache:
+                self.cache[source][ticker] = fields
+
+    def put_version(self, hash_, data):
+        '''Stores a version of financials (a dict of lists) by its hash, once'''
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO versions VALUES (?, ?)", (hash_, json.dumps(data)))
+
+    def put_snapshot(self, source, ticker, day, hash_, market_cap, valuation, commit=False):
+        '''Records the version of financials (see put_version), market cap and valuation of a ticker 
+        on a day, valuation is a dict of the valuations columns from params on'''
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)", 
+                              (source, ticker, day, hash_, market_cap))
+            self.conn.execute("INSERT OR REPLACE INTO valuations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (source, ticker, valuation["params"], day, hash_, valuation["status"],
+                               valuation["intrinsic_value"], valuation["uvf"], valuation["roe"], 
+                               valuation["margin"], valuation["roe_deviation"], valuation["debt_to_assets"]))
+            if commit:
+                self.conn.commit()
+
+    def latest_valuations(self, source, params, before=None):
+        '''Last valuation with params of every ticker of a source (before the day "before" if given) as 
+        a dict of ticker: dict of the valuations columns'''
+        with self.lock:
+            cursor = self.conn.execute('''SELECT * FROM valuations WHERE source = ? AND params = ? AND day < ?
+                                       ORDER BY ticker, day''', (source, params, before or "9999"))
+            names = [d[0] for d in cursor.description]
+            return {row[1]: dict(zip(names, row)) for row in cursor}
+
+    def version(self, hash_):
+        '''Financials of a snapshot by their hash'''
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM versions WHERE hash = ?", (hash_,)).fetchone()
+        if row is None:
+            raise KeyError(hash_)
+        return json.loads(row[0])
+
+    def uvf_history(self, source, ticker, params=None):
+        '''Undervaluation factor of a ticker over time as a list of (day, uvf) from the valuations
+        of every run, or only of runs with params'''
+        query = "SELECT day, uvf FROM valuations WHERE source = ? AND ticker = ?"
+        args = (source, ticker)
+        if params is not None:
+            query += " AND params = ?"
+            args += (params,)
+        with self.lock:
+            return self.conn.execute(query + " AND uvf IS NOT NULL ORDER BY day", args).fetchall()
+
+    def market_cap_history(self, source, ticker):
+        with self.lock:
+            return self.conn.execute('''SELECT day, market_cap FROM snapshots WHERE source = ? AND ticker = ?
+                                     ORDER BY day''', (source, ticker)).fetchall()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def source_name(dir_):
+    return os.path.basename(os.path.normpath(dir_))
+
+def import_br(store, dir_, source=None):
+    '''Imports biznesradar files saved by biznesradar_scraper.bulk_download - {ticker}-{statement}.json 
+    and {ticker}-info.json, statements of a ticker are merged the same way BrHandler does'''
+    source = source or source_name(dir_)
+    files = {}
+    for suffix in (br.INCOME, br.BALANCE, br.CASH, "info"):
+        for path in glob(f"{dir_}/*-{suffix}.json"):
+            ticker = os.path.basename(path)[:-len(f"-{suffix}.json")]
+            files.setdefault(ticker, []).append(path)
+    for ticker, paths in files.items():
+        data = {}
+        for path in paths:
+            with open(path) as file:
+                data.update(json.load(file))
+        store.put(source, ticker, data, commit=False)
+    store.commit()
+    log.info("imported %d tickers from %s", len(files), dir_)
+    return len(files)
+
+def import_gf(store, dir_, source=None):
+    '''Imports Google Finance files saved by googlefinance_scraper.get_financials - {ticker}.json'''
+    source = source or source_name(dir_)
+    paths = glob(f"{dir_}/*.json")
+    for path in paths:
+        with open(path) as file:
+            store.put(source, os.path.basename(path)[:-len(".json")], json.load(file), commit=False)
+    store.commit()
+    log.info("imported %d tickers from %s", len(paths), dir_)
+    return len(paths)
+
+if __name__ == "__main__":
+    verbose()
+    store = FinStore()
+    import_br(store, "data/gpw")
+    import_gf(store, "data/gf")
+    store.close()